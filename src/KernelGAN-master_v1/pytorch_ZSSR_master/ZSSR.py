@@ -6,6 +6,7 @@ from matplotlib.gridspec import GridSpec
 from .configs import Config
 from .utils import *
 from .simplenet import simpleNet
+from src.utils.self_ensemble import d4_forward
 
 
 class ZSSR:
@@ -272,6 +273,17 @@ class ZSSR:
             1,
         )
 
+    def forward_pass_batch(self, interpolated_batch):
+        # Run network on a (N, H, W, C) batch of already interpolated inputs
+        interpolated_batch = torch.Tensor(interpolated_batch).permute(0, 3, 1, 2)
+        if self.cuda:
+            interpolated_batch = interpolated_batch.cuda()
+        return np.clip(
+            self.model(interpolated_batch).cpu().detach().permute(0, 2, 3, 1).numpy(),
+            0,
+            1,
+        )
+
     def learning_rate_policy(self):
         # fit linear curve and check slope to determine whether to do nothing, reduce learning rate or finish
         if (
@@ -436,23 +448,19 @@ class ZSSR:
 
         # The weird range means we only do it once if output_flip is disabled
         # We need to check if scale factor is symmetric to all dimensions, if not we will do 180 jumps rather than 90
-        for k in range(
-            0, 1 + 7 * self.conf.output_flip, 1 + int(self.sf[0] != self.sf[1])
-        ):
-            # Rotate 90*k degrees and mirror flip when k>=4
-            test_input = (
-                np.rot90(self.input, k) if k < 4 else np.fliplr(np.rot90(self.input, k))
-            )
-
-            # Apply network on the rotated input
-            tmp_output = self.forward_pass(test_input)
+        ks = range(0, 1 + 7 * self.conf.output_flip, 1 + int(self.sf[0] != self.sf[1]))
+
+        # Interpolation commutes with the rotations and flips, so the input is interpolated once and
+        # the augmentations of it are stacked into one batch per output shape
+        interpolated_input = imresize(self.input, self.sf, None, self.conf.upscale_method)
+        if interpolated_input.ndim == 2:
+            interpolated_input = np.expand_dims(interpolated_input, axis=-1)
+        ensemble_outputs = d4_forward(
+            self.forward_pass_batch, interpolated_input[np.newaxis], ks=ks
+        )
 
-            # Undo the rotation for the processed output (mind the opposite order of the flip and the rotation)
-            tmp_output = (
-                np.rot90(tmp_output, -k)
-                if k < 4
-                else np.rot90(np.fliplr(tmp_output), -k)
-            )
+        for tmp_output in ensemble_outputs:
+            tmp_output = np.squeeze(tmp_output[0])
 
             # fix SR output with back projection technique for each augmentation
             for bp_iter in range(self.conf.back_projection_iters[self.sf_ind]):
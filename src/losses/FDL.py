@@ -61,9 +61,10 @@ class FDL_loss(torch.nn.Module):
         y = self.model(y)
         score = []
         for i in range(len(x)):
-            # Transform to Fourier Space
-            fft_x = torch.fft.fftn(x[i], dim=(-2, -1))
-            fft_y = torch.fft.fftn(y[i], dim=(-2, -1))
+            # Transform to Fourier Space, in fp32 as cuFFT only takes half
+            # precision inputs of power of two sizes
+            fft_x = torch.fft.fftn(x[i].float(), dim=(-2, -1))
+            fft_y = torch.fft.fftn(y[i].float(), dim=(-2, -1))
 
             # get the magnitude and phase of the extracted features
             x_mag = torch.abs(fft_x)
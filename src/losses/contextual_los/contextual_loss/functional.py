@@ -1,3 +1,5 @@
+import functools
+
 import torch
 import torch.nn.functional as F
 
@@ -6,6 +8,24 @@ from .config import LOSS_TYPES
 __all__ = ['contextual_loss', 'contextual_bilateral_loss']
 
 
+def fp32(func):
+    """
+    Runs func outside of autocast on fp32 tensors. Used for the steps which
+    lose precision or overflow in fp16/bf16 (distances close to zero, the
+    division by the minimum distance and the exponential), so the loss can be
+    used in mixed-precision training.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        tensors = [a for a in args if isinstance(a, torch.Tensor)]
+        device_type = tensors[0].device.type if tensors else 'cpu'
+        args = [a.float() if isinstance(a, torch.Tensor) and a.is_floating_point()
+                else a for a in args]
+        with torch.autocast(device_type=device_type, enabled=False):
+            return func(*args, **kwargs)
+    return wrapper
+
+
 def contextual_loss(x: torch.Tensor,
                     y: torch.Tensor,
                     band_width: float = 0.5,
@@ -116,18 +136,21 @@ def contextual_bilateral_loss(x: torch.Tensor,
     return cx_loss
 
 
+@fp32
 def compute_cx(dist_tilde, band_width):
     w = torch.exp((1 - dist_tilde) / band_width)  # Eq(3)
     cx = w / torch.sum(w, dim=2, keepdim=True)  # Eq(4)
     return cx
 
 
+@fp32
 def compute_relative_distance(dist_raw):
     dist_min, _ = torch.min(dist_raw, dim=2, keepdim=True)
     dist_tilde = dist_raw / (dist_min + 1e-5)
     return dist_tilde
 
 
+@fp32
 def compute_cosine_distance(x, y):
     # mean shifting by channel-wise mean of `y`.
     y_mu = y.mean(dim=(0, 2, 3), keepdim=True)
@@ -209,6 +232,7 @@ def compute_l1_distance(x: torch.Tensor, y: torch.Tensor):
 
 #     return dist
 
+@fp32
 def compute_l2_distance(x, y):
     N, C, H, W = x.size()
     x_vec = x.view(N, C, -1)
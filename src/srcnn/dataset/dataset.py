@@ -1,6 +1,7 @@
 from os import listdir
 from os.path import join
 
+import torch
 import torch.utils.data as data
 from PIL import Image
 import kornia
@@ -38,6 +39,48 @@ def aug_transform_training():
     return aug_list
 
 
+class D4Augmentation:
+    """random flips and rotations by multiples of 90 degrees (the 8 symmetries of
+    the square, D4) of lr and hr batches in one call, with the same transform for
+    input and target. Unlike aug_transform_training the transforms are exact index
+    permutations (flip, rot90) instead of interpolating warps, and the stage is
+    built once and reused every step.
+
+    Parameters
+    ----------
+    same_on_batch : bool, optional
+        one transform for the whole batch, as aug_transform_training, by default
+        True. Otherwise every sample gets its own, which needs square images when a
+        rotation by 90 degrees is drawn.
+    """
+
+    def __init__(self, same_on_batch=True):
+        self.same_on_batch = same_on_batch
+
+    @staticmethod
+    def apply(x, k):
+        """transform k in [0, 8) of a (..., H, W) tensor: rotation by k % 4 times
+        90 degrees, followed by a horizontal flip for k >= 4"""
+        x = torch.rot90(x, k % 4, dims=(-2, -1)) if k % 4 else x
+        return x.flip(-1) if k >= 4 else x
+
+    def __call__(self, data, target):
+        # transforms are drawn on the cpu, so no sync with the gpu
+        if self.same_on_batch:
+            k = int(torch.randint(8, ()))
+            return self.apply(data, k), self.apply(target, k)
+
+        ks = torch.randint(8, (data.shape[0],))
+        out_data, out_target = torch.empty_like(data), torch.empty_like(target)
+        for k in ks.unique().tolist():
+            index = (ks == k).nonzero().squeeze(1).to(data.device)
+            out_data.index_copy_(0, index, self.apply(data.index_select(0, index), k))
+            out_target.index_copy_(
+                0, index, self.apply(target.index_select(0, index), k)
+            )
+        return out_data, out_target
+
+
 class DatasetFromFolder(data.Dataset):
     def __init__(self, image_dir, input_transform=None, target_transform=None):
         super(DatasetFromFolder, self).__init__()
@@ -0,0 +1,106 @@
+import math
+import os
+import time
+
+from torch.utils.data import DataLoader
+
+
+def make_loader(
+    dataset,
+    batch_size,
+    num_workers=0,
+    pin_memory=False,
+    prefetch_factor=2,
+    persistent_workers=False,
+    **kwargs,
+):
+    """DataLoader with the worker options of the training config. prefetch_factor
+    and persistent_workers only apply to worker processes, so they are left out for
+    num_workers=0 (loading on the training thread), which DataLoader rejects.
+
+    Parameters
+    ----------
+    dataset : torch.utils.data.Dataset
+    batch_size : int
+    num_workers : int, optional
+        loader processes, by default 0
+    pin_memory : bool, optional
+        batches in page-locked memory for faster, asynchronous copies to the gpu,
+        by default False
+    prefetch_factor : int, optional
+        batches loaded in advance per worker, by default 2
+    persistent_workers : bool, optional
+        keep the workers (and the caches of their datasets) between epochs, by
+        default False
+    **kwargs
+        further arguments of DataLoader, e.g. shuffle or sampler
+    """
+    if num_workers > 0:
+        kwargs.update(
+            prefetch_factor=prefetch_factor, persistent_workers=persistent_workers
+        )
+    return DataLoader(
+        dataset=dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        **kwargs,
+    )
+
+
+def rebuild_loader(loader, **options):
+    """a loader of the same dataset, batch size and sampler (so shuffling and
+    ImageGroupedSampler are kept) with other worker options, see make_loader"""
+    return make_loader(
+        loader.dataset,
+        loader.batch_size,
+        sampler=loader.sampler,
+        drop_last=loader.drop_last,
+        **options,
+    )
+
+
+def time_loader(loader, num_batches=10):
+    """average seconds per batch of loader, e.g. the decode time of a batch for a
+    loader without workers
+
+    Returns
+    -------
+    (seconds per batch, last batch), the batch can be used to time a training step
+    """
+    batch = None
+    count = 0
+    start_time = time.perf_counter()
+    for batch in loader:
+        count += 1
+        if count == num_batches:
+            break
+    if count == 0:
+        raise ValueError("loader has no batches")
+    return (time.perf_counter() - start_time) / count, batch
+
+
+def pick_num_workers(decode_time, step_time, max_workers=None):
+    """number of loader workers which keep up with training. A worker delivers one
+    batch per decode_time, so ceil(decode_time / step_time) workers hide the decode,
+    one more absorbs slow batches. If decoding takes less than 5% of a step, loading
+    on the training thread is cheaper than the worker processes.
+
+    Parameters
+    ----------
+    decode_time : float
+        seconds to load a batch on one process, see time_loader
+    step_time : float
+        seconds of a training step
+    max_workers : int, optional
+        by default the cpu count minus one for the training process
+
+    Returns
+    -------
+    number of workers
+    """
+    if max_workers is None:
+        max_workers = max(0, (os.cpu_count() or 1) - 1)
+    if decode_time <= 0.05 * step_time:
+        return 0
+    return min(max_workers, math.ceil(decode_time / max(step_time, 1e-6)) + 1)
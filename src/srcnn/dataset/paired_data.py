@@ -6,6 +6,8 @@ from six.moves import urllib
 from torchvision.transforms import Compose, CenterCrop, ToTensor, Resize
 import skimage as ski
 from .dataset import PairedDatasetFromFolder as DatasetFromFolder, is_image_file
+from .shards import ShardDataset, pack_paired_shard, shard_is_current, shard_path
+from .patch_sampler import RandomPatchDataset
 
 CROP_SIZE = 64
 
@@ -32,8 +34,22 @@ def target_transform(crop_size):
     )
 
 
-def get_training_set(upscale_factor, data_dir, channeltype):
+def get_shard_set(upscale_factor, data_dir, channeltype, split):
+    """dataset of the pre-decoded and center cropped pairs of a split, the shard is
+    packed on first use and repacked when the files of the split changed"""
+    crop_size = calculate_valid_crop_size(CROP_SIZE, upscale_factor)
+    path = shard_path(data_dir, split, channeltype, upscale_factor, crop_size)
+    paired_data_dir = join(data_dir, split)
+    if not shard_is_current(path, paired_data_dir):
+        print(f"========== packing {split} pairs to {path} ==========")
+        pack_paired_shard(paired_data_dir, path, channeltype, upscale_factor, crop_size)
+    return ShardDataset(path)
+
+
+def get_training_set(upscale_factor, data_dir, channeltype, use_shards=False):
     print(f"========== PAIRED DATA from {data_dir} ==========")
+    if use_shards:
+        return get_shard_set(upscale_factor, data_dir, channeltype, "train")
     root_dir = data_dir
     train_dir = join(root_dir, "train")
     crop_size = calculate_valid_crop_size(CROP_SIZE, upscale_factor)
@@ -45,7 +61,30 @@ def get_training_set(upscale_factor, data_dir, channeltype):
     )
 
 
-def get_val_set(upscale_factor, data_dir, channeltype):
+def get_patch_training_set(
+    upscale_factor,
+    data_dir,
+    channeltype,
+    patches_per_image=16,
+    gradient_weighted=False,
+):
+    """random aligned crops of the training pairs instead of one center crop per
+    pair, patches_per_image crops per decoded pair. Use it with ImageGroupedSampler."""
+    print(f"========== PAIRED DATA PATCHES from {data_dir} ==========")
+    crop_size = calculate_valid_crop_size(CROP_SIZE, upscale_factor)
+    return RandomPatchDataset(
+        join(data_dir, "train"),
+        upscale_factor,
+        crop_size,
+        channeltype=channeltype,
+        patches_per_image=patches_per_image,
+        gradient_weighted=gradient_weighted,
+    )
+
+
+def get_val_set(upscale_factor, data_dir, channeltype, use_shards=False):
+    if use_shards:
+        return get_shard_set(upscale_factor, data_dir, channeltype, "val")
     root_dir = data_dir
     val_dir = join(root_dir, "val")
     crop_size = calculate_valid_crop_size(CROP_SIZE, upscale_factor)
@@ -58,7 +97,9 @@ def get_val_set(upscale_factor, data_dir, channeltype):
     )
 
 
-def get_test_set(upscale_factor, data_dir, channeltype):
+def get_test_set(upscale_factor, data_dir, channeltype, use_shards=False):
+    if use_shards:
+        return get_shard_set(upscale_factor, data_dir, channeltype, "test")
     root_dir = data_dir
     test_dir = join(root_dir, "test")
     crop_size = calculate_valid_crop_size(CROP_SIZE, upscale_factor)
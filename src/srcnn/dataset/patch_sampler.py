@@ -0,0 +1,168 @@
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.utils.data as data
+
+from .dataset import PairedDatasetFromFolder, load_img, load_rgb_img
+
+
+def gradient_crop_weights(lr, crop, percent=0.97):
+    """sampling weights of the top left corners of crop x crop windows of lr, the
+    sum of the gradient magnitude in the window. As KernelGAN's create_gradient_map,
+    the magnitude is clipped at the percent quantile so a few strong edges do not
+    take all the weight, and flat windows keep a small weight.
+
+    Parameters
+    ----------
+    lr : np.ndarray
+        (H, W, C) uint8 lr image
+    crop : int
+        lr crop size
+
+    Returns
+    -------
+    (H - crop + 1, W - crop + 1) float64 weights, not normalised
+    """
+    gray = lr.astype(np.float32).mean(axis=-1)
+    gy, gx = np.gradient(gray)
+    gmag = np.sqrt(gx**2 + gy**2)
+    gmag = np.minimum(gmag, np.quantile(gmag, percent))
+    # window sums from the integral image
+    integral = np.pad(gmag.astype(np.float64).cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    sums = (
+        integral[crop:, crop:]
+        - integral[:-crop, crop:]
+        - integral[crop:, :-crop]
+        + integral[:-crop, :-crop]
+    )
+    return sums + 0.1 * sums.mean() + 1e-6
+
+
+class RandomPatchDataset(data.Dataset):
+    """aligned random lr/hr crops of a paired data dir. Item i is a crop of pair
+    i // patches_per_image, so with ImageGroupedSampler every decoded pair gives
+    patches_per_image crops in a row. Decoded pairs are kept in an LRU cache of
+    cache_size pairs per loader worker.
+
+    Parameters
+    ----------
+    paired_data_dir : str
+        dir with input_lr and output_hr, as for PairedDatasetFromFolder
+    upscale_factor : int
+    crop_size : int
+        hr crop size, the lr crop is crop_size // upscale_factor
+    channeltype : str, optional
+        y or rgb, by default "y"
+    patches_per_image : int, optional
+        crops per pair and epoch, by default 16
+    cache_size : int, optional
+        decoded pairs kept per worker, by default 8
+    gradient_weighted : bool, optional
+        sample crops with probability by their gradient magnitude, see
+        gradient_crop_weights, by default False (uniform)
+    """
+
+    def __init__(
+        self,
+        paired_data_dir,
+        upscale_factor,
+        crop_size,
+        channeltype="y",
+        patches_per_image=16,
+        cache_size=8,
+        gradient_weighted=False,
+    ):
+        super(RandomPatchDataset, self).__init__()
+        # same file list and order as the folder dataset
+        folder = PairedDatasetFromFolder(paired_data_dir, channeltype=channeltype)
+        self.input_filenames = folder.input_filenames
+        self.output_filenames = folder.output_filenames
+        self.channeltype = channeltype
+        self.upscale_factor = upscale_factor
+        self.crop_size = crop_size
+        self.lr_crop = crop_size // upscale_factor
+        self.patches_per_image = patches_per_image
+        self.cache_size = cache_size
+        self.gradient_weighted = gradient_weighted
+        self._cache = OrderedDict()
+
+    def _load(self, path):
+        img = load_img(path) if self.channeltype == "y" else load_rgb_img(path)
+        if self.channeltype == "rgb" and img.mode != "RGB":
+            img = img.convert("RGB")
+        arr = np.asarray(img, dtype=np.uint8)
+        return arr[..., np.newaxis] if arr.ndim == 2 else arr
+
+    def _pair(self, image_index):
+        if image_index in self._cache:
+            self._cache.move_to_end(image_index)
+            return self._cache[image_index]
+        lr = self._load(self.input_filenames[image_index])
+        hr = self._load(self.output_filenames[image_index])
+        # crops have to fit in both images
+        h = min(lr.shape[0], hr.shape[0] // self.upscale_factor)
+        w = min(lr.shape[1], hr.shape[1] // self.upscale_factor)
+        if h < self.lr_crop or w < self.lr_crop:
+            raise ValueError(
+                f"pair {self.input_filenames[image_index]} is smaller than the crop size"
+            )
+        weights = None
+        if self.gradient_weighted:
+            weights = gradient_crop_weights(lr[:h, :w], self.lr_crop)
+            weights = torch.from_numpy(weights.ravel())
+        pair = (lr, hr, (h - self.lr_crop + 1, w - self.lr_crop + 1), weights)
+
+        self._cache[image_index] = pair
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return pair
+
+    def __getitem__(self, index):
+        lr, hr, (ny, nx), weights = self._pair(index // self.patches_per_image)
+        # torch generator, it is seeded per loader worker
+        if weights is None:
+            y = torch.randint(ny, ()).item()
+            x = torch.randint(nx, ()).item()
+        else:
+            y, x = divmod(torch.multinomial(weights, 1).item(), nx)
+
+        s, p = self.upscale_factor, self.lr_crop
+        lr_patch = lr[y : y + p, x : x + p]
+        hr_patch = hr[y * s : (y + p) * s, x * s : (x + p) * s]
+        # as ToTensor: (C, H, W) float in [0, 1]
+        input_image = torch.from_numpy(np.ascontiguousarray(lr_patch))
+        target = torch.from_numpy(np.ascontiguousarray(hr_patch))
+        return (
+            input_image.permute(2, 0, 1).float().div(255.0),
+            target.permute(2, 0, 1).float().div(255.0),
+        )
+
+    def __len__(self):
+        return len(self.input_filenames) * self.patches_per_image
+
+    def __getstate__(self):
+        # loader workers start with an empty cache
+        state = self.__dict__.copy()
+        state["_cache"] = OrderedDict()
+        return state
+
+
+class ImageGroupedSampler(data.Sampler):
+    """shuffles the pairs of a RandomPatchDataset and yields the indices of all
+    crops of a pair in a row, so each pair is decoded once per epoch while batches
+    still mix pairs at the boundaries. Use it in place of shuffle=True. With
+    several loader workers a pair is decoded once by each worker that gets one of
+    its batches."""
+
+    def __init__(self, dataset):
+        self.num_images = len(dataset.input_filenames)
+        self.patches_per_image = dataset.patches_per_image
+
+    def __iter__(self):
+        for image_index in torch.randperm(self.num_images).tolist():
+            start = image_index * self.patches_per_image
+            yield from range(start, start + self.patches_per_image)
+
+    def __len__(self):
+        return self.num_images * self.patches_per_image
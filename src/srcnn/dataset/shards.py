@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+import torch.utils.data as data
+from PIL import Image
+from torchvision.transforms import CenterCrop
+
+from .dataset import PairedDatasetFromFolder, load_img, load_rgb_img
+
+
+# a shard is <path>.u8 with the raw uint8 pixels of all images one after another,
+# <path>.index.npy with one row per pair:
+# (lr offset, lr h, lr w, lr c, hr offset, hr h, hr w, hr c)
+# and <path>.json with the settings and the (name, size, mtime) of the files it was
+# packed from
+DATA_SUFFIX = ".u8"
+INDEX_SUFFIX = ".index.npy"
+META_SUFFIX = ".json"
+
+
+def shard_path(data_dir, split, channeltype, upscale_factor, crop_size=None):
+    """path (without suffix) of the shard of a split of a paired data dir"""
+    crop = f"_crop{crop_size}" if crop_size else "_full"
+    return os.path.join(data_dir, f"{split}_{channeltype}_x{upscale_factor}{crop}")
+
+
+def shard_exists(path):
+    return all(
+        os.path.isfile(path + suffix) for suffix in (DATA_SUFFIX, INDEX_SUFFIX, META_SUFFIX)
+    )
+
+
+def _file_stats(filenames):
+    # what the shard was packed from, compared by shard_is_current
+    stats = [os.stat(x) for x in filenames]
+    return [
+        [os.path.basename(x), st.st_size, st.st_mtime_ns]
+        for x, st in zip(filenames, stats)
+    ]
+
+
+def shard_is_current(path, paired_data_dir):
+    """whether the shard exists and was packed from the current files of the paired
+    data dir, i.e. no pair was added, removed or changed (size or mtime) since"""
+    if not shard_exists(path):
+        return False
+    with open(path + META_SUFFIX) as f:
+        meta = json.load(f)
+    folder = PairedDatasetFromFolder(paired_data_dir)
+    input_files = _file_stats(folder.input_filenames)
+    output_files = _file_stats(folder.output_filenames)
+    return meta.get("input_files") == input_files and meta.get("output_files") == output_files
+
+
+def pack_paired_shard(
+    paired_data_dir, path, channeltype="y", upscale_factor=2, crop_size=None
+):
+    """decodes the lr/hr pairs of a paired data dir once and writes them to a shard
+
+    Parameters
+    ----------
+    paired_data_dir : str
+        dir with input_lr and output_hr, as for PairedDatasetFromFolder
+    path : str
+        shard path without suffix, see shard_path
+    channeltype : str, optional
+        y stores the Y plane, rgb the RGB image, by default "y"
+    upscale_factor : int, optional
+        by default 2
+    crop_size : int, optional
+        hr center crop size, the lr crop is crop_size // upscale_factor, as the
+        transforms of paired_data do. By default None, full frames are stored
+
+    Returns
+    -------
+    number of packed pairs
+    """
+    # same file list and order as the folder dataset
+    folder = PairedDatasetFromFolder(paired_data_dir, channeltype=channeltype)
+    load = load_img if channeltype == "y" else load_rgb_img
+    if crop_size:
+        lr_crop = CenterCrop(crop_size // upscale_factor)
+        hr_crop = CenterCrop(crop_size)
+
+    index = []
+    offset = 0
+    tmp_path = path + DATA_SUFFIX + ".tmp"
+    with open(tmp_path, mode="wb") as f:
+        for lr_path, hr_path in zip(folder.input_filenames, folder.output_filenames):
+            row = []
+            for img_path, crop in ((lr_path, "lr"), (hr_path, "hr")):
+                img = load(img_path)
+                if channeltype == "rgb" and img.mode != "RGB":
+                    img = img.convert("RGB")
+                if crop_size:
+                    img = (lr_crop if crop == "lr" else hr_crop)(img)
+                arr = np.asarray(img, dtype=np.uint8)
+                if arr.ndim == 2:
+                    arr = arr[..., np.newaxis]
+                f.write(np.ascontiguousarray(arr).tobytes())
+                row += [offset, *arr.shape]
+                offset += arr.size
+            index.append(row)
+    os.replace(tmp_path, path + DATA_SUFFIX)
+    np.save(path + INDEX_SUFFIX, np.asarray(index, dtype=np.int64).reshape(-1, 8))
+
+    meta = {
+        "paired_data_dir": str(paired_data_dir),
+        "channeltype": channeltype,
+        "upscale_factor": upscale_factor,
+        "crop_size": crop_size,
+        # [name, size, mtime_ns] per file
+        "input_files": _file_stats(folder.input_filenames),
+        "output_files": _file_stats(folder.output_filenames),
+    }
+    with open(path + META_SUFFIX, mode="w") as f:
+        json.dump(meta, f, indent=2)
+    return len(index)
+
+
+class ShardDataset(data.Dataset):
+    """lr/hr pairs of a packed shard. Items are read from a read-only memory map, so
+    no image is decoded during training and the page cache is shared by the loader
+    workers. Without transforms the pairs are returned as float tensors in [0, 1]
+    of shape (C, H, W), as ToTensor would; transforms get PIL images, e.g. for
+    shards of full frames.
+
+    Parameters
+    ----------
+    path : str
+        shard path without suffix, see shard_path
+    input_transform, target_transform : optional
+        transforms of the lr and the hr PIL image
+    """
+
+    def __init__(self, path, input_transform=None, target_transform=None):
+        super(ShardDataset, self).__init__()
+        self.path = path
+        self.index = np.load(path + INDEX_SUFFIX)
+        with open(path + META_SUFFIX) as f:
+            self.meta = json.load(f)
+        self.input_transform = input_transform
+        self.target_transform = target_transform
+        # opened on first access, so every loader worker maps the file itself
+        self._data = None
+
+    def _read(self, offset, h, w, c):
+        if self._data is None:
+            self._data = np.memmap(self.path + DATA_SUFFIX, dtype=np.uint8, mode="r")
+        # a copy of the item only, torch does not take read-only arrays
+        return np.array(self._data[offset : offset + h * w * c]).reshape(h, w, c)
+
+    def _convert(self, arr, transform):
+        if transform is None:
+            return torch.from_numpy(arr).permute(2, 0, 1).float().div(255.0)
+        img = Image.fromarray(arr[..., 0] if arr.shape[-1] == 1 else arr)
+        return transform(img)
+
+    def __getitem__(self, index):
+        row = self.index[index]
+        input_image = self._convert(self._read(*row[:4]), self.input_transform)
+        target = self._convert(self._read(*row[4:]), self.target_transform)
+        return input_image, target
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # the memory map is not sent to the loader workers
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+
+def main():
+    # packing the splits of a paired data dir, e.g. before training
+    parser = argparse.ArgumentParser(description="Pack paired SR data into shards")
+    parser.add_argument(
+        "--data_dir", type=str, required=True, help="dir with train, val and test"
+    )
+    parser.add_argument(
+        "--splits", type=str, nargs="+", default=["train", "val", "test"]
+    )
+    parser.add_argument(
+        "--channeltype",
+        "-ct",
+        type=str,
+        default="y",
+        help="channels for model. options- y and rgb.",
+    )
+    parser.add_argument(
+        "--upscale_factor", "-uf", type=int, default=2, help="upscale factor"
+    )
+    parser.add_argument(
+        "--crop_size",
+        type=int,
+        default=None,
+        help="hr center crop size, by default full frames",
+    )
+    args = parser.parse_args()
+
+    for split in args.splits:
+        path = shard_path(
+            args.data_dir, split, args.channeltype, args.upscale_factor, args.crop_size
+        )
+        n = pack_paired_shard(
+            os.path.join(args.data_dir, split),
+            path,
+            args.channeltype,
+            args.upscale_factor,
+            args.crop_size,
+        )
+        print(f"packed {n} pairs to {path}{DATA_SUFFIX}")
+
+
+if __name__ == "__main__":
+    main()
+    # example usage to run from cli
+    # python -m src.srcnn.dataset.shards --data_dir ./data/raw/div2k_data --crop_size 64
@@ -0,0 +1,122 @@
+"""Export of trained SR models for deployment and a lean loader for them.
+
+Only torch and the standard library are imported here, so loading an exported
+model does not need the src.srcnn model and solver modules (and with them kornia,
+lpips and matplotlib).
+"""
+
+import argparse
+import copy
+import json
+import os
+
+import torch
+
+
+STATE_FILE = "model_state.pth"
+TRACED_FILE = "model_traced.pt"
+META_FILE = "model_meta.json"
+
+
+def export_model(model, save_dir, upscale_factor, channeltype, example_size=64):
+    """writes a state_dict checkpoint and a traced TorchScript model, both with the
+    metadata of the model, to save_dir.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+    save_dir : str
+    upscale_factor : int
+    channeltype : str
+        y or rgb
+    example_size : int, optional
+        lr size of the example input used for tracing, by default 64
+
+    Returns
+    -------
+    metadata dict
+    """
+    num_channels = 1 if channeltype == "y" else 3
+    metadata = {
+        "architecture": type(model).__name__,
+        "upscale_factor": upscale_factor,
+        "channeltype": channeltype,
+        "num_channels": num_channels,
+    }
+
+    torch.save(
+        {"state_dict": model.state_dict(), "metadata": metadata},
+        os.path.join(save_dir, STATE_FILE),
+    )
+
+    # tracing a cpu copy so no device is baked into the graph
+    cpu_model = copy.deepcopy(model).cpu().eval()
+    example = torch.rand(1, num_channels, example_size, example_size)
+    with torch.no_grad():
+        traced = torch.jit.trace(cpu_model, example)
+    torch.jit.save(
+        traced,
+        os.path.join(save_dir, TRACED_FILE),
+        _extra_files={META_FILE: json.dumps(metadata)},
+    )
+
+    with open(os.path.join(save_dir, META_FILE), mode="w") as f:
+        json.dump(metadata, f, indent=2)
+    print("Exported model to {}".format(os.path.join(save_dir, TRACED_FILE)))
+    return metadata
+
+
+def load_traced_model(path, device="cpu"):
+    """loads a model written by export_model without the training code
+
+    Parameters
+    ----------
+    path : str
+        traced model file or the dir it was exported to
+    device : str or torch.device, optional
+        by default "cpu"
+
+    Returns
+    -------
+    (model in eval mode, metadata dict)
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, TRACED_FILE)
+    extra_files = {META_FILE: ""}
+    model = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    metadata = json.loads(extra_files[META_FILE]) if extra_files[META_FILE] else {}
+    return model.eval(), metadata
+
+
+def main():
+    # exporting an already trained, pickled model_path.pth
+    parser = argparse.ArgumentParser(description="Export SR model for deployment")
+    parser.add_argument(
+        "--save_dir", type=str, required=True, help="dir where model is saved"
+    )
+    parser.add_argument(
+        "--file_name", type=str, default="model_path", help="name of saved model file"
+    )
+    parser.add_argument(
+        "--channeltype",
+        "-ct",
+        type=str,
+        default="y",
+        help="channels for model. options- y and rgb.",
+    )
+    parser.add_argument(
+        "--upscale_factor", "-uf", type=int, default=2, help="upscale factor of model"
+    )
+    args = parser.parse_args()
+
+    model = torch.load(
+        os.path.join(args.save_dir, args.file_name + ".pth"),
+        map_location=lambda storage, loc: storage,
+    )
+    export_model(model, args.save_dir, args.upscale_factor, args.channeltype)
+
+
+if __name__ == "__main__":
+    main()
+    # example usage to run from cli
+    # python -m src.srcnn.export --save_dir ./model --channeltype rgb
@@ -1,11 +1,10 @@
 from src.my_logger import Logger
-from src.visualization.plot_utils import inference_plot_and_save
 from src.utils.utils import is_image_file
-from src.visualization.plot_utils import plot_image_grid, calc_avg_metrics
-from src.utils.patch_and_combine import (
-    creates_lr_patches_hr_merge_indices,
-    merge_hr_patches,
-)
+from src.srcnn.tile_engine import TileEngine
+from src.srcnn.pipeline import run_pipeline
+from src.utils.mmap_image import open_lr_memmap, create_hr_memmap
+from src.srcnn.export import load_traced_model, TRACED_FILE
+from src.utils.output_store import OutputStore, BaselineCache, file_hash
 
 import os
 from os import listdir
@@ -16,129 +15,283 @@ import time
 
 
 import torch
-import torch.backends.cudnn as cudnn
 from PIL import Image
-from torchvision.transforms import ToTensor
-import numpy as np
-import torchvision.transforms.functional as F
-from torch.profiler import profile, record_function, ProfilerActivity
+
+
+def list_inputs(inference_dir, mmap=False):
+    """sorted input images of inference_dir and its subdirs, the 200x jpgs or with
+    mmap the raw .npy images (see src.utils.mmap_image)"""
+    inference_dir = Path(inference_dir)
+    if mmap:
+        input_filenames = list(inference_dir.rglob("*.npy"))
+    else:
+        # filtering images with "200" resolution
+        input_filenames = [
+            x
+            for x in inference_dir.rglob("*.jpg")
+            if is_image_file(str(x)) and "200x" in str(x)
+        ]
+    return sorted(input_filenames)
+
+
+def load_model(save_dir, device, filename=None, traced=False):
+    """loads the pickled model of save_dir, or the traced model exported to it (see
+    src.srcnn.export)
+
+    Returns
+    -------
+    (model in eval mode, metadata dict, empty for a pickled model, checkpoint path)
+    """
+    if traced:
+        checkpoint_path = os.path.join(save_dir, TRACED_FILE)
+        model, metadata = load_traced_model(checkpoint_path, device)
+        return model, metadata, checkpoint_path
+    checkpoint_path = os.path.join(save_dir, (filename or "model_path") + ".pth")
+    model = torch.load(checkpoint_path, map_location=lambda storage, loc: storage)
+    return model.to(device).eval(), {}, checkpoint_path
 
 
 class Inference:
     def __init__(
-        self, inference_dir, save_dir, filename=None, channeltype=None, ps=256
+        self,
+        inference_dir,
+        save_dir,
+        filename=None,
+        channeltype=None,
+        ps=256,
+        batch_size=4,
+        mmap=False,
+        precision="fp32",
+        channels_last=False,
+        min_precision_psnr=40.0,
+        output_norm="clamp",
+        traced=False,
+        scale=None,
+        out_dir=None,
+        manifest=None,
+        use_store=True,
+        store_dir=None,
+        baseline_dir=None,
+        overlap=0.2,
+        merge="overwrite",
     ):
         self.inference_dir = Path(inference_dir)
-        self.allfilenames = list(self.inference_dir.rglob("*.jpg"))
-
-        self.input_filenames = [x for x in (self.allfilenames)]
-        # filtering images with "200" resolution
-        self.input_filenames = [
-            x for x in (self.allfilenames) if is_image_file(str(x)) and "200x" in str(x)
-        ]
-        self.input_filenames.sort()
+        self.mmap = mmap
+        self.input_filenames = list_inputs(self.inference_dir, mmap)
         self.device = torch.device("cuda:0" if GPU_IN_USE else "cpu:0")
         self.channeltype = channeltype
         # ===========================================================
         # model import & setting
         # ===========================================================
-        if filename:
-            self.model = save_dir + "/" + filename + ".pth"
-        else:
-            self.model = save_dir + "/model_path.pth"
-        model = torch.load(self.model, map_location=lambda storage, loc: storage)
-        self.model = model.to(self.device).eval()
+        self.model, metadata, checkpoint_path = load_model(
+            save_dir, self.device, filename, traced
+        )
+        self.channeltype = self.channeltype or metadata.get("channeltype")
+        architecture = metadata.get("architecture")
+        scale = scale or metadata.get("upscale_factor")
 
         # ===========================================================
         # creating output dir
         # ===========================================================
 
-        out_dir = save_dir
-        t = datetime.now().strftime("_%b_%d_%H_%M_%S_%f") + "/"
-
-        self.out_dir = os.path.join(out_dir, t)
-        os.makedirs(self.out_dir)
-        self.ps = ps
+        if out_dir:
+            # fixed dir, e.g. shared by the workers of a sharded run
+            self.out_dir = os.path.join(out_dir, "")
+            os.makedirs(self.out_dir, exist_ok=True)
+        else:
+            t = datetime.now().strftime("_%b_%d_%H_%M_%S_%f") + "/"
+            self.out_dir = os.path.join(save_dir, t)
+            os.makedirs(self.out_dir)
+        # completed images are recorded in it, see src.srcnn.sharded_inference
+        self.manifest = manifest
+        self.engine = TileEngine(
+            self.model,
+            self.device,
+            self.channeltype,
+            ps=ps,
+            batch_size=batch_size,
+            precision=precision,
+            channels_last=channels_last,
+            output_norm=output_norm,
+            architecture=architecture,
+            scale=scale,
+            overlap=overlap,
+            merge=merge,
+        )
+        # ps="auto" is resolved by the tile planner, scale=None from the model
+        self.ps = self.engine.ps
+        self.scale = self.engine.scale
+        # low precision output is checked against fp32 on the first image
+        self.min_precision_psnr = min_precision_psnr
+        self.precision_checked = precision == "fp32"
+        # outputs are cached by checkpoint, input and tile config, see OutputStore.
+        # Not for mmap outputs: a copy of images larger than RAM into the store and
+        # back would double the disk use and copy the full file on every run
+        use_store = use_store and not mmap
+        self.store = (
+            OutputStore(store_dir or os.path.join(save_dir, "output_store"))
+            if use_store
+            else None
+        )
+        self.checkpoint_hash = file_hash(checkpoint_path) if use_store else None
+        self.store_keys = {}
+        # bicubic baselines are shared by all checkpoints
+        if use_store:
+            self.baselines = (
+                BaselineCache(baseline_dir) if baseline_dir else BaselineCache()
+            )
+        else:
+            self.baselines = None
 
     @torch.inference_mode(mode=True)
-    def inference(self):
+    def inference(
+        self, decode_workers=2, encode_workers=2, decode_queue_depth=4, encode_queue_depth=4
+    ):
+        """decoding, SR and encoding of the images overlap: decode workers feed a
+        bounded queue, SR runs on this thread and encoder threads save the outputs."""
         logger_instance = Logger()
         logger_instance.initialize("inference")
-        logger = logger_instance.get_logger()
-        times = []
-        for lr_path in self.input_filenames:
-            start_time = time.perf_counter()
-
-            lr_img = Image.open(lr_path)
-            lr_patches, hr_indices = creates_lr_patches_hr_merge_indices(
-                lr_img, self.ps, scale=2
-            )
-            hr_patches = []
-
-            for img in lr_patches:
-                out_img = self.single_img_sr(img)
-                hr_patches.append(out_img)
-            out_img = merge_hr_patches(hr_patches, hr_indices)
-
-            file_base_name = os.path.splitext(os.path.basename(lr_path))[0]
-            out_img.save(self.out_dir + file_base_name + "_sr_hr.png")
-            size = (lr_img.size[0] * 2, lr_img.size[1] * 2)
-            end_time = time.perf_counter()
-            times.append(end_time - start_time)
-            print(
-                f"time for single patch of {self.ps} size: {end_time - start_time:.4f} seconds"
-            )
-            logger.info(
-                f"time for single patch of {self.ps} size: {end_time - start_time:.4f} seconds"
-            )
-            bicubic_hr = lr_img.resize(size, Image.BICUBIC)
-            bicubic_hr.save(self.out_dir + file_base_name + "_bicubic_hr.png")
+        self.logger = logger_instance.get_logger()
 
-        logger.info(f"avg time :{sum(times)/len(times)}")
+        start_time = time.perf_counter()
+        todo = self.restore_outputs(self.input_filenames)
+        timer = run_pipeline(
+            todo,
+            self.decode,
+            self.compute,
+            self.encode,
+            decode_workers=decode_workers,
+            encode_workers=encode_workers,
+            decode_queue_depth=decode_queue_depth,
+            encode_queue_depth=encode_queue_depth,
+        )
+        total_time = time.perf_counter() - start_time
+        self.engine.session.close()
 
-    @torch.inference_mode(mode=True)
-    def single_img_sr(self, img):
+        for stage, (count, total, avg) in timer.summary().items():
+            self.logger.info(
+                f"{stage}: {count} calls, total {total:.4f} seconds, avg {avg:.4f} seconds"
+            )
+        self.logger.info(
+            f"total time for {len(self.input_filenames)} images: {total_time:.4f} seconds"
+        )
+        return timer
+
+    def store_key(self, lr_path):
+        return OutputStore.key(
+            checkpoint=self.checkpoint_hash,
+            input=file_hash(lr_path),
+            config=self.engine.config(),
+            mmap=self.mmap,
+        )
 
-        if self.channeltype == "y":
-            y, cb, cr = img.convert("YCbCr").split()
-        if self.channeltype == "rgb":
-            y = img
+    def output_base(self, lr_path):
+        """path of the outputs of lr_path without the <_name>.png suffix. The path of
+        lr_path relative to inference_dir is mirrored in out_dir, so images of the
+        same name in different subdirs do not overwrite each other"""
+        try:
+            rel_path = Path(lr_path).relative_to(self.inference_dir)
+        except ValueError:
+            rel_path = Path(os.path.basename(lr_path))
+        base = os.path.join(self.out_dir, str(rel_path.with_suffix("")))
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        return base
 
-        data = (ToTensor()(y)).view(1, -1, y.size[1], y.size[0])
-        data = data.to(self.device)
+    def restore_outputs(self, lr_paths):
+        """copies the stored outputs of the images already super-resolved with this
+        checkpoint and tile config into out_dir, returns the remaining images"""
+        if self.store is None:
+            return lr_paths
+        todo = []
+        for lr_path in lr_paths:
+            key = self.store_key(lr_path)
+            base = self.output_base(lr_path)
+            record = self.store.restore(
+                key, os.path.dirname(base), prefix=os.path.basename(base) + "_"
+            )
+            if record is None:
+                self.store_keys[str(lr_path)] = key
+                todo.append(lr_path)
+                continue
+            outputs = list(record["files"].values())
+            outputs.append(self.save_bicubic(lr_path))
+            if self.manifest is not None:
+                self.manifest.add(lr_path, outputs)
+        self.logger.info(
+            f"{len(lr_paths) - len(todo)} of {len(lr_paths)} images restored from {self.store.root}"
+        )
+        return todo
 
-        if GPU_IN_USE:
-            cudnn.benchmark = True
+    def decode(self, lr_path):
+        if self.mmap:
+            return open_lr_memmap(lr_path)
+        lr_img = Image.open(lr_path)
+        # PIL opens lazily, loading here so the decode happens in the worker
+        lr_img.load()
+        return lr_img
 
-        # ===========================================================
-        # output and save image
-        # ===========================================================
+    def compute(self, lr_path, lr_img):
+        if self.mmap:
+            # hr patches are merged straight into a memory-mapped file
+            h, w, c = lr_img.shape
+            out = create_hr_memmap(
+                self.output_base(lr_path) + "_sr_hr.npy",
+                (h * self.scale, w * self.scale, c),
+            )
+            out_img = self.engine.super_resolve_array(lr_img, out=out)
+        else:
+            if not self.precision_checked:
+                psnr = self.engine.check_precision(lr_img, self.min_precision_psnr)
+                self.logger.info(
+                    f"{self.engine.precision} psnr against fp32 output: {psnr:.2f} dB"
+                )
+                self.precision_checked = True
+            out_img = self.engine.super_resolve(lr_img)
+        self.logger.info(
+            f"{os.path.basename(lr_path)}: {self.engine.stats['patches']} patches of {self.ps} size, "
+            f"batch size {self.engine.batch_size}: {self.engine.stats['patches_per_sec']:.2f} patches/sec"
+        )
+        return lr_img, out_img
 
-        if self.channeltype == "y":
-
-            out = self.model(data)
-            out = out.cpu()
-            out_img_y = out.data[0].numpy()
-            out_img_y *= 255.0
-            out_img_y = out_img_y.clip(0, 255)
-            out_img_y = Image.fromarray(np.uint8(out_img_y[0]), mode="L")
-            out_img_cb = cb.resize(out_img_y.size, Image.BICUBIC)
-            out_img_cr = cr.resize(out_img_y.size, Image.BICUBIC)
-            out_img = Image.merge("YCbCr", [out_img_y, out_img_cb, out_img_cr]).convert(
-                "RGB"
+    def encode(self, lr_path, result):
+        lr_img, out_img = result
+        if self.mmap:
+            # png encoding and bicubic baseline would need the full image in memory
+            out_img.flush()
+            outputs = [out_img.filename]
+        else:
+            out_path = self.output_base(lr_path) + "_sr_hr.png"
+            out_img.save(out_path)
+            outputs = [out_path]
+        if self.store is not None:
+            # outputs are named <input name>_<store name>
+            prefix = len(os.path.splitext(os.path.basename(lr_path))[0]) + 1
+            self.store.put(
+                self.store_keys[str(lr_path)],
+                {os.path.basename(o)[prefix:]: o for o in outputs},
             )
+        if not self.mmap:
+            outputs.append(self.save_bicubic(lr_path, lr_img))
+        if self.manifest is not None:
+            self.manifest.add(lr_path, outputs)
 
-        if self.channeltype == "rgb":
-            out = self.model(data)
-            out = out.cpu()
-            out_img_y = out.data[0].numpy()
-            out_img_y = np.moveaxis(out_img_y, 0, -1)
-            a = out_img_y
-            out_img_y = 255 * (a - np.min(a)) / np.ptp(a)
-            out_img = Image.fromarray(np.uint8(out_img_y), mode="RGB")
+    def save_bicubic(self, lr_path, lr_img=None):
+        """saves the bicubic hr image of lr_path to out_dir, from the baseline cache
+        if there is one, and returns its path"""
+        out_path = self.output_base(lr_path) + "_bicubic_hr.png"
 
-        torch.cuda.empty_cache()
-        return out_img
+        def compute():
+            lr = lr_img if lr_img is not None else Image.open(lr_path)
+            size = (lr.size[0] * self.scale, lr.size[1] * self.scale)
+            return lr.resize(size, Image.BICUBIC), None
+
+        if self.baselines is None:
+            compute()[0].save(out_path)
+        else:
+            self.baselines.get_or_compute(
+                lr_path, self.scale, "pil", out_path, compute
+            )
+        return out_path
 
     def cuda_prop(self):
         # printing global gpu memory info
@@ -175,15 +328,113 @@ def main():
         default="y",
         help="channels for model. options- y and rgb.",
     )
+    parser.add_argument(
+        "--ps",
+        type=lambda x: x if x == "auto" else int(x),
+        default=256,
+        help="lr patch size, auto probes the model for the patch and batch size with the highest throughput that fits in memory",
+    )
+    parser.add_argument(
+        "--upscale_factor",
+        "-uf",
+        type=int,
+        default=None,
+        help="upscale factor of the model, by default read from the model",
+    )
+    parser.add_argument(
+        "--overlap",
+        type=float,
+        default=0.2,
+        help="overlap of the patches, blended merges need less overlap for the same seams",
+    )
+    parser.add_argument(
+        "--merge",
+        type=str,
+        default="overwrite",
+        choices=["overwrite", "avg", "linear", "spline"],
+        help="merge of overlapping patches: overwrite, average or blend with a linear or spline window. All but overwrite keep float32 buffers of about 5x the uint8 hr image",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=4,
+        help="number of patches per forward pass, ignored with --ps auto",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16", "fp16"],
+        help="autocast precision of the forward pass",
+    )
+    parser.add_argument(
+        "--channels_last",
+        action="store_true",
+        help="run the model in channels_last memory format",
+    )
+    parser.add_argument(
+        "--output_norm",
+        type=str,
+        default="clamp",
+        choices=["clamp", "global", "tile"],
+        help="mapping of model output to uint8: clamp, one min/max stretch per image (global) or per patch (tile)",
+    )
+    parser.add_argument(
+        "--traced",
+        action="store_true",
+        help="load the traced model exported to save_dir instead of the pickled model",
+    )
+    parser.add_argument(
+        "--no_store",
+        action="store_true",
+        help="recompute all outputs instead of reusing the ones stored for this checkpoint, "
+        "mmap outputs are never stored",
+    )
+    parser.add_argument(
+        "--mmap",
+        action="store_true",
+        help="super-resolve raw .npy images memory-mapped, for images larger than RAM",
+    )
+    parser.add_argument(
+        "--decode_workers", type=int, default=2, help="number of image decode threads"
+    )
+    parser.add_argument(
+        "--encode_workers", type=int, default=2, help="number of png encode threads"
+    )
+    parser.add_argument(
+        "--queue_depth",
+        type=int,
+        default=4,
+        help="max number of images waiting between decode, SR and encode",
+    )
 
     args = parser.parse_args()
     print(args)
     # setting the inference directory containing test data
     inference_dir = os.getcwd() + "/data/raw/all_data/test_images"
     inferencer = Inference(
-        inference_dir, args.save_dir, args.file_name, args.channeltype
+        inference_dir,
+        args.save_dir,
+        args.file_name,
+        args.channeltype,
+        ps=args.ps,
+        batch_size=args.batch_size,
+        mmap=args.mmap,
+        precision=args.precision,
+        channels_last=args.channels_last,
+        output_norm=args.output_norm,
+        traced=args.traced,
+        scale=args.upscale_factor,
+        use_store=not args.no_store,
+        overlap=args.overlap,
+        merge=args.merge,
+    )
+    inferencer.inference(
+        decode_workers=args.decode_workers,
+        encode_workers=args.encode_workers,
+        decode_queue_depth=args.queue_depth,
+        encode_queue_depth=args.queue_depth,
     )
-    inferencer.inference()
 
 
 if __name__ == "__main__":
@@ -8,12 +8,12 @@ import numpy as np
 import random
 import torch
 
-from torch.utils.data import DataLoader
-
 from .DBPN.solver import DBPNTrainer
 from .SRCNN.solver import SRCNNTrainer
 from .SubPixelCNN.solver import SubPixelTrainer
 from .dataset import paired_data
+from .dataset.patch_sampler import ImageGroupedSampler
+from .dataset.loader import make_loader
 
 from src.srcnn.super_resolve_rgb import MixValidation
 from src.srcnn.inference import Inference
@@ -82,6 +82,60 @@ parser.add_argument(
     help="name of the experiment for saving model, its settings, evaluation results",
 )
 parser.add_argument("--set_num", type=int, help="which set of fdata")
+parser.add_argument(
+    "--shards",
+    action="store_true",
+    help="train on pre-decoded memory-mapped shards of the pairs, packed on first use",
+)
+parser.add_argument(
+    "--patches_per_image",
+    type=int,
+    default=0,
+    help="train on this many random crops per decoded pair instead of one center crop, 0 to disable",
+)
+parser.add_argument(
+    "--gradient_sampling",
+    action="store_true",
+    help="sample the random crops by their gradient magnitude",
+)
+
+# mixed precision
+parser.add_argument(
+    "--precision",
+    type=str,
+    default="fp32",
+    choices=["fp32", "bf16", "fp16"],
+    help="autocast precision of the training step, bf16 on cpu, fp16 with gradient scaling on gpu",
+)
+parser.add_argument(
+    "--fp32_loss",
+    action="store_true",
+    help="compute the loss in fp32 on the fp32 output with --precision bf16/fp16",
+)
+
+# data loading
+parser.add_argument(
+    "--num_workers",
+    type=lambda x: x if x == "auto" else int(x),
+    default=0,
+    help="loader worker processes, auto picks them from a benchmark of decode and step time at startup",
+)
+parser.add_argument(
+    "--pin_memory",
+    action="store_true",
+    help="load batches into page-locked memory for asynchronous copies to the gpu",
+)
+parser.add_argument(
+    "--prefetch_factor",
+    type=int,
+    default=2,
+    help="batches loaded in advance per worker",
+)
+parser.add_argument(
+    "--persistent_workers",
+    action="store_true",
+    help="keep the loader workers between epochs",
+)
 
 
 args = parser.parse_args()
@@ -160,24 +214,58 @@ def main():
 
         save_conf(args)
 
-        train_set = paired_data.get_training_set(
-            args.upscale_factor, data_dir=data_dir, channeltype=args.channeltype
-        )
+        if args.patches_per_image:
+            train_set = paired_data.get_patch_training_set(
+                args.upscale_factor,
+                data_dir=data_dir,
+                channeltype=args.channeltype,
+                patches_per_image=args.patches_per_image,
+                gradient_weighted=args.gradient_sampling,
+            )
+        else:
+            train_set = paired_data.get_training_set(
+                args.upscale_factor,
+                data_dir=data_dir,
+                channeltype=args.channeltype,
+                use_shards=args.shards,
+            )
         val_set = paired_data.get_val_set(
-            args.upscale_factor, data_dir=data_dir, channeltype=args.channeltype
+            args.upscale_factor,
+            data_dir=data_dir,
+            channeltype=args.channeltype,
+            use_shards=args.shards,
         )
         test_set = paired_data.get_test_set(
-            args.upscale_factor, data_dir=data_dir, channeltype=args.channeltype
+            args.upscale_factor,
+            data_dir=data_dir,
+            channeltype=args.channeltype,
+            use_shards=args.shards,
         )
 
-        training_data_loader = DataLoader(
-            dataset=train_set, batch_size=args.batchSize, shuffle=True
+        # with num_workers auto the trainer benchmarks and rebuilds the loaders
+        loader_options = dict(
+            num_workers=0 if args.num_workers == "auto" else args.num_workers,
+            pin_memory=args.pin_memory,
+            prefetch_factor=args.prefetch_factor,
+            persistent_workers=args.persistent_workers,
         )
-        validation_data_loader = DataLoader(
-            dataset=val_set, batch_size=args.testBatchSize, shuffle=False
+        if args.patches_per_image:
+            # crops of a pair in a row, so the pair is decoded once
+            training_data_loader = make_loader(
+                train_set,
+                args.batchSize,
+                sampler=ImageGroupedSampler(train_set),
+                **loader_options,
+            )
+        else:
+            training_data_loader = make_loader(
+                train_set, args.batchSize, shuffle=True, **loader_options
+            )
+        validation_data_loader = make_loader(
+            val_set, args.testBatchSize, shuffle=False, **loader_options
         )
-        testing_data_loader = DataLoader(
-            dataset=test_set, batch_size=args.testBatchSize, shuffle=False
+        testing_data_loader = make_loader(
+            test_set, args.testBatchSize, shuffle=False, **loader_options
         )
 
         if args.model == "sub":
@@ -251,7 +339,12 @@ def model_test(args, PAIRED_DATA_DIR):
 def model_inference(args):
     # hardcoded path for unprocessed test images
     inference_dir = os.getcwd() + "/data/raw/all_data/Images_set3"
-    inferencer = Inference(inference_dir, args.save_dir, channeltype=args.channeltype)
+    inferencer = Inference(
+        inference_dir,
+        args.save_dir,
+        channeltype=args.channeltype,
+        scale=args.upscale_factor,
+    )
     inferencer.inference()
 
 
@@ -0,0 +1,159 @@
+import queue
+import threading
+import time
+from collections import defaultdict
+
+
+_DONE = object()
+
+
+class StageTimes:
+    """thread-safe record of the time spent per pipeline stage"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.times = defaultdict(list)
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.times[stage].append(seconds)
+
+    def summary(self):
+        """returns {stage: (count, total seconds, avg seconds)}"""
+        with self._lock:
+            return {
+                stage: (len(t), sum(t), sum(t) / len(t))
+                for stage, t in self.times.items()
+                if t
+            }
+
+
+def _put(q, item, stop):
+    # blocking put which gives up once the pipeline is stopped
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def run_pipeline(
+    items,
+    decode,
+    compute,
+    encode,
+    decode_workers=2,
+    encode_workers=2,
+    decode_queue_depth=4,
+    encode_queue_depth=4,
+    timer=None,
+):
+    """runs decode -> compute -> encode over items with the stages overlapping.
+    Decode workers fill a bounded queue, compute runs on the calling thread (so the
+    model and torch inference mode stay on one thread) and a pool of encoder threads
+    consumes the results from a second bounded queue.
+
+    Parameters
+    ----------
+    items : iterable, e.g. input file paths
+    decode : function(item) -> decoded
+    compute : function(item, decoded) -> result
+    encode : function(item, result) -> None
+    decode_workers, encode_workers : int, optional
+        number of threads of the decode and encode stage, by default 2
+    decode_queue_depth, encode_queue_depth : int, optional
+        max number of items waiting for the next stage, by default 4
+    timer : StageTimes, optional
+        timings are added to it, by default a new one
+
+    Returns
+    -------
+    StageTimes with decode, compute, encode and wait (compute waiting on decode) timings
+    """
+    timer = timer if timer is not None else StageTimes()
+    stop = threading.Event()
+    errors = []
+
+    in_q = queue.Queue()
+    for item in items:
+        in_q.put(item)
+    decoded_q = queue.Queue(maxsize=decode_queue_depth)
+    encode_q = queue.Queue(maxsize=encode_queue_depth)
+
+    def decode_worker():
+        try:
+            while not stop.is_set():
+                try:
+                    item = in_q.get_nowait()
+                except queue.Empty:
+                    break
+                start_time = time.perf_counter()
+                decoded = decode(item)
+                timer.add("decode", time.perf_counter() - start_time)
+                if not _put(decoded_q, (item, decoded), stop):
+                    break
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            _put(decoded_q, _DONE, stop)
+
+    def encode_worker():
+        while True:
+            job = encode_q.get()
+            if job is _DONE:
+                break
+            if errors:
+                # draining the queue after a failure
+                continue
+            try:
+                start_time = time.perf_counter()
+                encode(*job)
+                timer.add("encode", time.perf_counter() - start_time)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+
+    decoders = [
+        threading.Thread(target=decode_worker, daemon=True)
+        for _ in range(decode_workers)
+    ]
+    encoders = [
+        threading.Thread(target=encode_worker, daemon=True)
+        for _ in range(encode_workers)
+    ]
+    for t in decoders + encoders:
+        t.start()
+
+    try:
+        finished = 0
+        wait_start = time.perf_counter()
+        while finished < decode_workers and not stop.is_set():
+            try:
+                job = decoded_q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if job is _DONE:
+                finished += 1
+                continue
+            timer.add("wait", time.perf_counter() - wait_start)
+            item, decoded = job
+            start_time = time.perf_counter()
+            result = compute(item, decoded)
+            timer.add("compute", time.perf_counter() - start_time)
+            _put(encode_q, (item, result), stop)
+            wait_start = time.perf_counter()
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for _ in encoders:
+            encode_q.put(_DONE)
+        for t in encoders:
+            t.join()
+
+    if errors:
+        raise errors[0]
+    return timer
@@ -0,0 +1,321 @@
+"""Local HTTP super-resolution service.
+
+The model is loaded once. Images are POSTed to /sr and the SR image is returned as
+png. The patches of concurrent requests are coalesced into shared batches by one
+compute thread, and GET /stats returns the queue depth and per-stage latencies.
+Bodies larger than --max_body_mb are rejected with 413.
+
+    python -m src.srcnn.serve --save_dir ./model --channeltype rgb --port 8080
+    curl --data-binary @lr.png http://localhost:8080/sr -o sr.png
+"""
+
+import argparse
+import io
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+from PIL import Image
+
+from src.srcnn.inference import load_model
+from src.srcnn.pipeline import StageTimes
+from src.srcnn.tile_engine import TileEngine
+
+
+class TileBatcher:
+    """coalesces lr patches of concurrent requests into batches of the engine batch
+    size. A batch is run once it is full or its first patch waited max_latency.
+    Patches smaller than the tile size (images smaller than ps) are edge padded to
+    it, so all patches stack into one batch.
+
+    Parameters
+    ----------
+    engine : TileEngine
+    max_latency : float, optional
+        seconds the first patch of a batch waits for more patches, by default 0.02
+    timer : StageTimes, optional
+        batch_wait (per patch), compute and batch_fill are added to it
+    """
+
+    def __init__(self, engine, max_latency=0.02, timer=None):
+        self.engine = engine
+        self.max_latency = max_latency
+        self.timer = timer if timer is not None else StageTimes()
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def depth(self):
+        """number of patches waiting for a batch"""
+        return self._queue.qsize()
+
+    def submit(self, batch):
+        """runs the (N, H, W, C) uint8 lr patches in shared batches and returns their
+        hr patches, blocking until all of them are done. Can be passed as forward to
+        TileEngine.super_resolve."""
+        futures = []
+        for patch in batch:
+            future = Future()
+            self._queue.put((patch, future, time.perf_counter()))
+            futures.append(future)
+        return np.stack([f.result() for f in futures])
+
+    def _run(self):
+        ps, batch_size, scale = self.engine.ps, self.engine.batch_size, self.engine.scale
+        while not self._stop.is_set():
+            try:
+                jobs = [self._queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            deadline = jobs[0][2] + self.max_latency
+            while len(jobs) < batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    jobs.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            start_time = time.perf_counter()
+            for _, _, submitted in jobs:
+                self.timer.add("batch_wait", start_time - submitted)
+            self.timer.add("batch_fill", len(jobs) / batch_size)
+            try:
+                patches = [
+                    np.pad(
+                        p,
+                        ((0, ps - p.shape[0]), (0, ps - p.shape[1]), (0, 0)),
+                        mode="edge",
+                    )
+                    for p, _, _ in jobs
+                ]
+                with torch.inference_mode():
+                    hr_patches = self.engine.forward_batch(np.stack(patches))
+                for (p, future, _), hr in zip(jobs, hr_patches):
+                    future.set_result(hr[: p.shape[0] * scale, : p.shape[1] * scale])
+            except Exception as e:
+                for _, future, _ in jobs:
+                    future.set_exception(e)
+            self.timer.add("compute", time.perf_counter() - start_time)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def make_handler(engine, batcher, timer, max_body_bytes=64 * 2**20):
+    """request handler class serving the engine, rejecting bodies over
+    max_body_bytes"""
+    in_flight = [0]
+    lock = threading.Lock()
+
+    class SRHandler(BaseHTTPRequestHandler):
+        def _send(self, code, body, content_type):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_json(self, code, obj):
+            self._send(code, json.dumps(obj).encode(), "application/json")
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(200, {"status": "ok"})
+            elif self.path == "/stats":
+                with lock:
+                    requests_in_flight = in_flight[0]
+                self._send_json(
+                    200,
+                    {
+                        "queue_depth": batcher.depth,
+                        "requests_in_flight": requests_in_flight,
+                        "config": engine.config(),
+                        "batch_size": engine.batch_size,
+                        # {stage: [count, total, avg]}, seconds except for
+                        # batch_fill and patches_per_sec
+                        "stages": timer.summary(),
+                    },
+                )
+            else:
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/sr":
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+                return
+            with lock:
+                in_flight[0] += 1
+            try:
+                start_time = time.perf_counter()
+                try:
+                    length = int(self.headers.get("Content-Length", ""))
+                except ValueError:
+                    self._send_json(411, {"error": "missing or invalid Content-Length"})
+                    return
+                if length < 0 or length > max_body_bytes:
+                    # the body is not read, so the connection cannot be reused
+                    self.close_connection = True
+                    self._send_json(
+                        413, {"error": f"body over the limit of {max_body_bytes} bytes"}
+                    )
+                    return
+                body = self.rfile.read(length)
+                try:
+                    lr_img = Image.open(io.BytesIO(body))
+                    lr_img.load()
+                except Exception as e:
+                    self._send_json(400, {"error": f"cannot decode image: {e}"})
+                    return
+                decoded = time.perf_counter()
+                timer.add("decode", decoded - start_time)
+
+                out_img = engine.super_resolve(lr_img, forward=batcher.submit)
+                sr_done = time.perf_counter()
+                timer.add("sr", sr_done - decoded)
+                # stats of this request, engine.stats is per handler thread
+                timer.add("patches_per_sec", engine.stats["patches_per_sec"])
+
+                buf = io.BytesIO()
+                out_img.save(buf, format="PNG")
+                timer.add("encode", time.perf_counter() - sr_done)
+                self._send(200, buf.getvalue(), "image/png")
+                timer.add("request", time.perf_counter() - start_time)
+            except Exception as e:
+                self._send_json(500, {"error": str(e)})
+            finally:
+                with lock:
+                    in_flight[0] -= 1
+
+        def log_message(self, format, *args):
+            # no access log per request, latencies are in /stats
+            pass
+
+    return SRHandler
+
+
+def serve(
+    engine, host="127.0.0.1", port=8080, max_latency=0.02, max_body_bytes=64 * 2**20
+):
+    """serves the engine until interrupted
+
+    Parameters
+    ----------
+    engine : TileEngine
+    host : str, optional
+        by default only local connections
+    port : int, optional
+        by default 8080
+    max_latency : float, optional
+        seconds a patch waits for patches of other requests, by default 0.02
+    max_body_bytes : int, optional
+        larger request bodies are rejected with 413, by default 64 MiB
+    """
+    timer = StageTimes()
+    batcher = TileBatcher(engine, max_latency=max_latency, timer=timer)
+    server = ThreadingHTTPServer(
+        (host, port), make_handler(engine, batcher, timer, max_body_bytes)
+    )
+    server.daemon_threads = True
+    print(f"serving SR on http://{host}:{port}/sr, stats on /stats")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        engine.session.close()
+
+
+def main():
+    # ===========================================================
+    # Argument settings
+    # ===========================================================
+    parser = argparse.ArgumentParser(description="PyTorch Super Res service")
+    parser.add_argument(
+        "--save_dir", type=str, default="None", help="dir where model is saved"
+    )
+    parser.add_argument(
+        "--file_name", type=str, default="model_path", help="name of saved model file"
+    )
+    parser.add_argument(
+        "--traced",
+        action="store_true",
+        help="load the traced model exported to save_dir instead of the pickled model",
+    )
+    parser.add_argument(
+        "--channeltype",
+        "-ct",
+        type=str,
+        default=None,
+        help="channels for model. options- y and rgb. by default from the traced model",
+    )
+    parser.add_argument(
+        "--ps",
+        type=lambda x: x if x == "auto" else int(x),
+        default=256,
+        help="lr patch size, auto probes the model for the patch and batch size with the highest throughput that fits in memory",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=4,
+        help="number of patches per forward pass, ignored with --ps auto",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16", "fp16"],
+        help="autocast precision of the forward pass",
+    )
+    parser.add_argument(
+        "--max_latency_ms",
+        type=float,
+        default=20.0,
+        help="max time a patch waits for patches of other requests",
+    )
+    parser.add_argument(
+        "--max_body_mb",
+        type=float,
+        default=64.0,
+        help="max size of a posted image, larger requests are rejected with 413",
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="host to bind")
+    parser.add_argument("--port", type=int, default=8080, help="port to bind")
+
+    args = parser.parse_args()
+    print(args)
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu:0")
+    model, metadata, _ = load_model(args.save_dir, device, args.file_name, args.traced)
+    engine = TileEngine(
+        model,
+        device,
+        args.channeltype or metadata.get("channeltype", "y"),
+        ps=args.ps,
+        batch_size=args.batch_size,
+        precision=args.precision,
+        scale=metadata.get("upscale_factor"),
+        architecture=metadata.get("architecture"),
+    )
+    serve(
+        engine,
+        args.host,
+        args.port,
+        max_latency=args.max_latency_ms / 1000,
+        max_body_bytes=int(args.max_body_mb * 2**20),
+    )
+
+
+if __name__ == "__main__":
+    main()
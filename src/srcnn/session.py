@@ -0,0 +1,127 @@
+import torch
+import torch.backends.cudnn as cudnn
+import torch.nn.functional as F
+
+
+# autocast dtype per precision option, fp32 runs without autocast
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+class InferenceSession:
+    """owns the SR model and device for a whole inference run. cudnn autotuning is
+    switched on once, and batches are padded to a fixed set of tile shapes and a fixed
+    batch size, so the kernels are tuned once and the cached allocator blocks are
+    reused for every batch instead of being released per patch.
+
+    Parameters
+    ----------
+    model : SR model, already on device and in eval mode
+    device : torch.device
+    precision : str, optional
+        fp32, bf16 or fp16 autocast for the forward pass, by default "fp32".
+        bf16 also works on cpu
+    channels_last : bool, optional
+        run the model and inputs in channels_last memory format, by default False
+    tile_shapes : list of (int, int), optional
+        canonical (H, W) lr shapes, inputs are padded to the smallest one they fit in,
+        by default none (inputs run at their own shape)
+    batch_size : int, optional
+        smaller batches are padded to this size, by default None (no padding)
+    """
+
+    def __init__(
+        self,
+        model,
+        device,
+        precision="fp32",
+        channels_last=False,
+        tile_shapes=None,
+        batch_size=None,
+    ):
+        if precision not in PRECISIONS:
+            raise ValueError(
+                f"precision has to be either one of {list(PRECISIONS)}, but got {precision}"
+            )
+        self.device = torch.device(device)
+        self.channels_last = channels_last
+        if channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        self.model = model
+        self.precision = precision
+        # smallest area first, so the first fitting shape wastes the least compute
+        self.tile_shapes = sorted(tile_shapes or [], key=lambda s: s[0] * s[1])
+        self.batch_size = batch_size
+
+        if self.device.type == "cuda":
+            cudnn.benchmark = True
+
+    def canonical_shape(self, h, w):
+        """smallest tile shape which (h, w) fits in, (h, w) itself if none fits"""
+        for th, tw in self.tile_shapes:
+            if h <= th and w <= tw:
+                return th, tw
+        return h, w
+
+    @torch.inference_mode(mode=True)
+    def forward(self, data, pad_batch=True, pad_shape=True):
+        """runs the model on a (N, C, H, W) float batch already on the device, padding
+        it to the canonical shape and batch size and cropping the output back.
+
+        Parameters
+        ----------
+        data : torch.Tensor
+        pad_batch : bool, optional
+            pad the batch to batch_size, by default True
+        pad_shape : bool, optional
+            replicate pad the tiles to the canonical shape, by default True. Set
+            pad_batch and pad_shape False for single full images, which are not tiles
+            of a run and would get padded borders otherwise
+
+        Returns
+        -------
+        (N, C', H*scale, W*scale) float32 output on the device
+        """
+        n, _, h, w = data.shape
+        th, tw = self.canonical_shape(h, w) if pad_shape else (h, w)
+        if (th, tw) != (h, w):
+            data = F.pad(data, (0, tw - w, 0, th - h), mode="replicate")
+        if pad_batch and self.batch_size and n < self.batch_size:
+            data = torch.cat([data, data.new_zeros((self.batch_size - n,) + data.shape[1:])])
+        if self.channels_last:
+            data = data.contiguous(memory_format=torch.channels_last)
+
+        dtype = PRECISIONS[self.precision]
+        with torch.autocast(
+            device_type=self.device.type,
+            dtype=dtype or torch.float32,
+            enabled=dtype is not None,
+        ):
+            out = self.model(data)
+
+        scale = out.shape[2] // th
+        return out[:n, :, : h * scale, : w * scale].float()
+
+    @torch.inference_mode(mode=True)
+    def upscale_factor(self, num_channels, size=32):
+        """upscale factor of the model, from one forward pass of a small input.
+        For multi-stage models (e.g. two x2 stages) this is the overall factor.
+
+        Parameters
+        ----------
+        num_channels : int
+            input channels of the model, 1 for y and 3 for rgb
+        size : int, optional
+            lr size of the probe input, by default 32
+        """
+        data = torch.rand(1, num_channels, size, size, device=self.device)
+        out = self.forward(data, pad_batch=False, pad_shape=False)
+        if out.shape[2] % size or out.shape[3] % size:
+            raise ValueError(
+                f"model output {tuple(out.shape[2:])} is not an integer multiple of the input {size}"
+            )
+        return out.shape[2] // size
+
+    def close(self):
+        """releases the cached device memory once the run is done"""
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
@@ -0,0 +1,306 @@
+import argparse
+import json
+import multiprocessing
+import os
+import threading
+import time
+from pathlib import Path
+
+import torch
+
+from src.my_logger import Logger
+
+
+MANIFEST_PREFIX = "manifest"
+
+
+class Manifest:
+    """append-only record of the completed images of a run. Every worker writes its
+    own jsonl file in the output dir, so no locking between processes is needed, and
+    a resumed run reads all of them.
+
+    Parameters
+    ----------
+    out_dir : str
+    name : str
+        file name of this writer, e.g. manifest_shard0of2_w1.jsonl
+    """
+
+    def __init__(self, out_dir, name):
+        self.path = os.path.join(out_dir, name)
+        # encode threads of the pipeline add concurrently
+        self._lock = threading.Lock()
+
+    def add(self, lr_path, outputs):
+        record = {"input": str(lr_path), "outputs": [str(o) for o in outputs]}
+        with self._lock, open(self.path, mode="a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+
+    @staticmethod
+    def completed(out_dir):
+        """inputs of all manifests in out_dir whose outputs all still exist"""
+        done = set()
+        for path in Path(out_dir).glob(MANIFEST_PREFIX + "*.jsonl"):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # last line of a killed worker
+                        continue
+                    if all(os.path.isfile(o) for o in record["outputs"]):
+                        done.add(record["input"])
+        return done
+
+
+def shard_files(filenames, shard_index, shard_count):
+    """the files of one shard, every shard_count-th file of the sorted list, so shards
+    are balanced and the same on every machine"""
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(
+            f"shard_index has to be in [0, {shard_count}), but got {shard_index}"
+        )
+    return sorted(filenames)[shard_index::shard_count]
+
+
+def _worker(filenames, manifest_name, num_threads, inference_kwargs, pipeline_kwargs):
+    # one process per worker, each with its own copy of the model
+    from src.srcnn.inference import Inference
+
+    torch.set_num_threads(num_threads)
+    logger_instance = Logger()
+    log_name = os.path.splitext(manifest_name)[0] + ".log"
+    logger_instance.initialize(
+        "inference", log_file=os.path.join(inference_kwargs["out_dir"], log_name)
+    )
+    inferencer = Inference(
+        manifest=Manifest(inference_kwargs["out_dir"], manifest_name),
+        **inference_kwargs,
+    )
+    inferencer.input_filenames = filenames
+    inferencer.inference(**pipeline_kwargs)
+
+
+def run_sharded(
+    inference_dir,
+    save_dir,
+    out_dir,
+    workers=2,
+    num_threads=None,
+    shard_index=0,
+    shard_count=1,
+    pipeline_kwargs=None,
+    **inference_kwargs,
+):
+    """super-resolves the images of inference_dir with several worker processes.
+    The sorted file list is split into shard_count shards (e.g. one per machine),
+    this call runs shard shard_index, split again over the workers. Images recorded
+    as completed in the manifests of out_dir are skipped, so an interrupted run is
+    resumed by calling it again with the same out_dir.
+
+    Parameters
+    ----------
+    inference_dir : str
+    save_dir : str
+        dir of the model
+    out_dir : str
+        output dir shared by all workers and shards, the outputs mirror the subdirs
+        of inference_dir
+    workers : int, optional
+        number of worker processes, by default 2
+    num_threads : int, optional
+        torch threads per worker, by default the cpu count divided by workers
+    shard_index, shard_count : int, optional
+        shard of this machine, by default 0 and 1 (no sharding)
+    pipeline_kwargs : dict, optional
+        decode/encode workers and queue depths of Inference.inference
+    **inference_kwargs
+        further arguments of Inference, e.g. channeltype, ps, precision
+
+    Returns
+    -------
+    number of images processed by this call
+    """
+    from src.srcnn.inference import list_inputs, load_model
+    from src.srcnn.tile_planner import plan_tiles
+
+    if num_threads is None:
+        num_threads = max(1, (os.cpu_count() or 1) // workers)
+    pipeline_kwargs = pipeline_kwargs or {}
+    os.makedirs(out_dir, exist_ok=True)
+
+    logger_instance = Logger()
+    logger_instance.initialize(
+        "inference",
+        log_file=os.path.join(out_dir, f"sharded_{shard_index}of{shard_count}.log"),
+    )
+    logger = logger_instance.get_logger()
+
+    filenames = [
+        str(f) for f in list_inputs(inference_dir, inference_kwargs.get("mmap", False))
+    ]
+    if inference_kwargs.get("ps") == "auto":
+        # the parent plans once with the thread count of a worker, so the workers
+        # do not probe the model concurrently. Only the model is loaded for it
+        torch.set_num_threads(num_threads)
+        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu:0")
+        model, metadata, _ = load_model(
+            save_dir,
+            device,
+            inference_kwargs.get("filename"),
+            inference_kwargs.get("traced", False),
+        )
+        channeltype = inference_kwargs.get("channeltype") or metadata.get(
+            "channeltype", "y"
+        )
+        plan = plan_tiles(
+            model,
+            device,
+            num_channels=1 if channeltype == "y" else 3,
+            architecture=metadata.get("architecture"),
+            precision=inference_kwargs.get("precision", "fp32"),
+            channels_last=inference_kwargs.get("channels_last", False),
+            overlap=inference_kwargs.get("overlap", 0.2),
+        )
+        inference_kwargs.update(ps=plan["tile"], batch_size=plan["batch_size"])
+        del model
+
+    filenames = shard_files(filenames, shard_index, shard_count)
+    done = Manifest.completed(out_dir)
+    todo = [f for f in filenames if f not in done]
+    logger.info(
+        f"shard {shard_index}/{shard_count}: {len(filenames)} images, "
+        f"{len(filenames) - len(todo)} already done, {len(todo)} to do "
+        f"with {workers} workers of {num_threads} threads"
+    )
+    if not todo:
+        return 0
+
+    inference_kwargs.update(
+        inference_dir=inference_dir, save_dir=save_dir, out_dir=out_dir
+    )
+    start_time = time.perf_counter()
+    # spawn, forked children would inherit the torch thread pools and cuda state
+    ctx = multiprocessing.get_context("spawn")
+    processes = []
+    for w in range(min(workers, len(todo))):
+        manifest_name = f"{MANIFEST_PREFIX}_shard{shard_index}of{shard_count}_w{w}.jsonl"
+        p = ctx.Process(
+            target=_worker,
+            args=(
+                todo[w::workers],
+                manifest_name,
+                num_threads,
+                inference_kwargs,
+                pipeline_kwargs,
+            ),
+        )
+        p.start()
+        processes.append(p)
+    for p in processes:
+        p.join()
+
+    failed = [w for w, p in enumerate(processes) if p.exitcode != 0]
+    if failed:
+        raise RuntimeError(
+            f"workers {failed} failed, completed images are kept in the manifests of {out_dir}, run again to resume"
+        )
+    logger.info(
+        f"{len(todo)} images in {time.perf_counter() - start_time:.4f} seconds"
+    )
+    return len(todo)
+
+
+def main():
+    # ===========================================================
+    # Argument settings
+    # ===========================================================
+    parser = argparse.ArgumentParser(description="Sharded multi-process SR inference")
+    parser.add_argument(
+        "--save_dir", type=str, default="None", help="dir where model is saved"
+    )
+    parser.add_argument(
+        "--out_dir",
+        type=str,
+        required=True,
+        help="output dir, rerun with the same dir to resume",
+    )
+    parser.add_argument(
+        "--inference_dir",
+        type=str,
+        default=os.getcwd() + "/data/raw/all_data/test_images",
+        help="dir of the input images",
+    )
+    parser.add_argument(
+        "--file_name", type=str, default="model_path", help="name of saved model file"
+    )
+    parser.add_argument(
+        "--channeltype",
+        "-ct",
+        type=str,
+        default="y",
+        help="channels for model. options- y and rgb.",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=2, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="torch threads per worker, by default cpu count / workers",
+    )
+    parser.add_argument(
+        "--shard_index", type=int, default=0, help="shard run on this machine"
+    )
+    parser.add_argument(
+        "--shard_count", type=int, default=1, help="number of shards (machines)"
+    )
+    parser.add_argument(
+        "--ps",
+        type=lambda x: x if x == "auto" else int(x),
+        default=256,
+        help="lr patch size, auto probes the model for the patch and batch size with the highest throughput that fits in memory",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16", "fp16"],
+        help="autocast precision of the forward pass",
+    )
+    parser.add_argument(
+        "--traced",
+        action="store_true",
+        help="load the traced model exported to save_dir instead of the pickled model",
+    )
+    parser.add_argument(
+        "--mmap",
+        action="store_true",
+        help="super-resolve raw .npy images memory-mapped, for images larger than RAM",
+    )
+
+    args = parser.parse_args()
+    print(args)
+    run_sharded(
+        args.inference_dir,
+        args.save_dir,
+        args.out_dir,
+        workers=args.workers,
+        num_threads=args.threads,
+        shard_index=args.shard_index,
+        shard_count=args.shard_count,
+        filename=args.file_name,
+        channeltype=args.channeltype,
+        ps=args.ps,
+        precision=args.precision,
+        traced=args.traced,
+        mmap=args.mmap,
+    )
+
+
+if __name__ == "__main__":
+    main()
+    # example usage to run from cli, shard 0 of 2 machines
+    # python -m src.srcnn.sharded_inference --save_dir ./model --out_dir ./sr_out --workers 4 --shard_index 0 --shard_count 2
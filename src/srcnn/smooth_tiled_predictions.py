@@ -25,6 +25,8 @@ import numpy as np
 import scipy.signal
 from tqdm import tqdm
 
+from src.utils.self_ensemble import d4_self_ensemble
+
 
 if __name__ == "__main__":
     import matplotlib.pyplot as plt
@@ -41,10 +43,10 @@ def _spline_window(window_size, power=2):
     https://www.wolframalpha.com/input/?i=y%3Dx**2,+y%3D-(x-2)**2+%2B2,+y%3D(x-4)**2,+from+y+%3D+0+to+2
     """
     intersection = int(window_size / 4)
-    wind_outer = (abs(2 * (scipy.signal.triang(window_size))) ** power) / 2
+    wind_outer = (abs(2 * (scipy.signal.windows.triang(window_size))) ** power) / 2
     wind_outer[intersection:-intersection] = 0
 
-    wind_inner = 1 - (abs(2 * (scipy.signal.triang(window_size) - 1)) ** power) / 2
+    wind_inner = 1 - (abs(2 * (scipy.signal.windows.triang(window_size) - 1)) ** power) / 2
     wind_inner[:intersection] = 0
     wind_inner[-intersection:] = 0
 
@@ -233,22 +235,92 @@ def _recreate_from_subdivs(subdivs, window_size, subdivisions, padded_out_shape)
     return y / (subdivisions**2)
 
 
+def _windowed_accumulate(
+    padded_img, window_size, subdivisions, nb_classes, pred_func, batch_size
+):
+    """
+    Streaming version of `_windowed_subdivs` followed by `_recreate_from_subdivs`.
+    Windows are given to `pred_func` in batches of `batch_size`, weighted with the
+    cached 2D spline window and added in place to the output, so no 5D array of all
+    the patches is built. Patches are summed in the same order as the original
+    path, which gives the same result.
+    """
+    WINDOW_SPLINE_2D = _window_2D(window_size=window_size, power=2)
+
+    step = int(window_size / subdivisions)
+    padx_len = padded_img.shape[0]
+    pady_len = padded_img.shape[1]
+
+    y = np.zeros(list(padded_img.shape[:-1]) + [nb_classes])
+
+    offsets = [
+        (i, j)
+        for i in range(0, padx_len - window_size + 1, step)
+        for j in range(0, pady_len - window_size + 1, step)
+    ]
+    for k in range(0, len(offsets), batch_size):
+        batch_offsets = offsets[k : k + batch_size]
+        batch = np.stack(
+            [
+                padded_img[i : i + window_size, j : j + window_size, :]
+                for i, j in batch_offsets
+            ]
+        )
+        preds = pred_func(batch)
+        for (i, j), pred in zip(batch_offsets, preds):
+            y[i : i + window_size, j : j + window_size] += pred * WINDOW_SPLINE_2D
+
+    return y / (subdivisions**2)
+
+
 def predict_img_with_smooth_windowing(
-    input_img, window_size, subdivisions, nb_classes, pred_func
+    input_img,
+    window_size,
+    subdivisions,
+    nb_classes,
+    pred_func,
+    batch_size=None,
+    tile_ensemble=None,
 ):
     """
     Apply the `pred_func` function to square patches of the image, and overlap
     the predictions to merge them smoothly.
     See 6th, 7th and 8th idea here:
     http://blog.kaggle.com/2017/05/09/dstl-satellite-imagery-competition-3rd-place-winners-interview-vladimir-sergey/
+
+    With `batch_size` set, `pred_func` gets batches of at most `batch_size` windows
+    which are accumulated into the output right away (see `_windowed_accumulate`),
+    so the 5D array of all the patches is not built. Without `tile_ensemble` the 8
+    rotated and mirrored padded copies of the image and their 8 padded results are
+    still kept, so memory is about 16 padded images.
+
+    With `tile_ensemble` ("mean" or "median"), the D4 self-ensemble is done per
+    batch of windows instead of over 8 rotated copies of the padded image: the 8
+    transforms of each batch go through `pred_func` as one stacked batch (8 times
+    `batch_size` windows) and are merged right away. Only one padded image and one
+    padded result are kept, so memory is of the order of the image.
     """
     pad = _pad_img(input_img, window_size, subdivisions)
+
+    if tile_ensemble:
+        # the 2D spline window is symmetric, so weighting after undoing the
+        # transforms is the same as weighting the transformed predictions
+        padded_results = _windowed_accumulate(
+            pad,
+            window_size,
+            subdivisions,
+            nb_classes,
+            lambda batch: d4_self_ensemble(pred_func, batch, reduce=tile_ensemble),
+            batch_size or 1,
+        )
+        prd = _unpad_img(padded_results, window_size, subdivisions)
+        return prd[: input_img.shape[0], : input_img.shape[1], :]
+
     pads = _rotate_mirror_do(pad)
 
-    # Note that the implementation could be more memory-efficient by merging
-    # the behavior of `_windowed_subdivs` and `_recreate_from_subdivs` into
-    # one loop doing in-place assignments to the new image matrix, rather than
-    # using a temporary 5D array.
+    # Without `batch_size`, the temporary 5D array of `_windowed_subdivs` is
+    # built and merged by `_recreate_from_subdivs`; `_windowed_accumulate` does
+    # both in one loop with in-place additions to the new image matrix.
 
     # It would also be possible to allow different (and impure) window functions
     # that might not tile well. Adding their weighting to another matrix could
@@ -267,13 +339,20 @@ def predict_img_with_smooth_windowing(
     res = []
     for pad in tqdm(pads):
         # For every rotation:
-        sd = _windowed_subdivs(pad, window_size, subdivisions, nb_classes, pred_func)
-        one_padded_result = _recreate_from_subdivs(
-            sd,
-            window_size,
-            subdivisions,
-            padded_out_shape=list(pad.shape[:-1]) + [nb_classes],
-        )
+        if batch_size:
+            one_padded_result = _windowed_accumulate(
+                pad, window_size, subdivisions, nb_classes, pred_func, batch_size
+            )
+        else:
+            sd = _windowed_subdivs(
+                pad, window_size, subdivisions, nb_classes, pred_func
+            )
+            one_padded_result = _recreate_from_subdivs(
+                sd,
+                window_size,
+                subdivisions,
+                padded_out_shape=list(pad.shape[:-1]) + [nb_classes],
+            )
 
         res.append(one_padded_result)
 
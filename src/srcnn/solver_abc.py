@@ -1,11 +1,16 @@
 from src.losses import lpipss
 from src.visualization.plot_utils import EarlyStopper, plot_image_grid
-from src.srcnn.dataset.dataset import aug_transform_training
+from src.srcnn.dataset.dataset import D4Augmentation
 from src.my_logger import Logger
 from src.losses.FDL import FDL_loss
 from src.losses.contextual_los import contextual_loss as cl
+from src.srcnn.export import export_model
+from src.srcnn.dataset.loader import pick_num_workers, rebuild_loader, time_loader
+from src.srcnn.session import PRECISIONS
+from src.srcnn.tile_planner import RSSSampler, current_rss
 
 import random
+import time
 from math import log10
 
 from abc import ABC, abstractmethod
@@ -37,6 +42,7 @@ class Trainer(ABC):
         self.testing_loader = testing_loader
         self.mseloss = torch.nn.L1Loss()
         self.save_dir = config.save_dir
+        self.channeltype = config.channeltype
         if config.channeltype == "y":
             self.num_channels = 1
         if config.channeltype == "rgb":
@@ -45,9 +51,33 @@ class Trainer(ABC):
         if hasattr(config, "dbpntype"):
             self.dbpntype = config.dbpntype
 
+        # worker options of the loaders, num_workers "auto" is resolved in run
+        self.loader_options = dict(
+            num_workers=getattr(config, "num_workers", 0),
+            pin_memory=getattr(config, "pin_memory", False),
+            prefetch_factor=getattr(config, "prefetch_factor", 2),
+            persistent_workers=getattr(config, "persistent_workers", False),
+        )
+
+        # mixed precision of the training step, fp16 uses a gradient scaler
+        self.precision = getattr(config, "precision", "fp32")
+        if self.precision not in PRECISIONS:
+            raise ValueError(
+                f"precision has to be either one of {list(PRECISIONS)}, but got {self.precision}"
+            )
+        if self.precision == "fp16" and not self.CUDA:
+            raise ValueError("fp16 training needs a gpu, use bf16 on cpu")
+        # compute the loss in fp32 on the fp32 output, for losses unstable in fp16/bf16
+        self.fp32_loss = getattr(config, "fp32_loss", False)
+        self.scaler = torch.amp.GradScaler(
+            self.device.type, enabled=self.precision == "fp16"
+        )
+
         # SETTING loss type
         self.losstype = losstype
         self.l1_loss = nn.L1Loss()
+        # flips and rot90 of input and target, built once
+        self.augment = D4Augmentation()
 
     @abstractmethod
     def build_model(self):
@@ -104,32 +134,76 @@ class Trainer(ABC):
         model_out_path = self.save_dir + "/model_path.pth"
         torch.save(self.model, model_out_path)
         print("Checkpoint saved to {}".format(model_out_path))
+        # state_dict and traced model for deployment, see src.srcnn.export. The
+        # checkpoint above is kept if the model cannot be traced
+        try:
+            export_model(
+                self.model, self.save_dir, self.upscale_factor, self.channeltype
+            )
+        except Exception as e:
+            self.logger.warning(f"export of the model for deployment failed: {e}")
+
+    def autocast(self):
+        """autocast context of the configured precision, disabled for fp32"""
+        dtype = PRECISIONS[self.precision]
+        return torch.autocast(
+            device_type=self.device.type,
+            dtype=dtype or torch.float32,
+            enabled=dtype is not None,
+        )
+
+    def compute_loss(self, output, target):
+        if self.losstype == "cobi":
+            loss = self.criterion(output, target)
+            output_patches, target_patches = self.get_patches(output, target)
+            loss = loss + 0.0001 * self.criterion_cobi_rgb(
+                output_patches, target_patches
+            )
+        else:
+            loss = self.criterion(output, target)
+        return loss
+
+    def train_step(self, data, target):
+        """augmentation, forward and backward pass of a batch, returns the loss"""
+        # non_blocking overlaps the copy of pinned batches with the compute
+        data = data.to(self.device, non_blocking=True)
+        target = target.to(self.device, non_blocking=True)
+
+        data, target = self.augment(data, target)
+
+        self.optimizer.zero_grad()
+        with self.autocast():
+            output = self.model(data)
+            if not self.fp32_loss:
+                loss = self.compute_loss(output, target)
+        if self.fp32_loss:
+            loss = self.compute_loss(output.float(), target)
+        # scaled for fp16 so small gradients do not underflow, no-op otherwise
+        self.scaler.scale(loss).backward()
+        return loss
 
     def train(self):
         self.model.train()
         train_loss = 0
+        # time the training thread waits for the next batch
+        loader_wait = 0.0
+        start_time = time.perf_counter()
+        fetch_start = start_time
         for batch_num, (data, target) in enumerate(self.training_loader):
-            data, target = data.to(self.device), target.to(self.device)
-
-            aug_list = aug_transform_training()
-            data = aug_list(data)
-            target = aug_list(target, params=aug_list._params)
-
-            self.optimizer.zero_grad()
-            output = self.model(data)
-            if self.losstype == "cobi":
-                loss = self.criterion(output, target)
-                output_patches, target_patches = self.get_patches(output, target)
-                loss = loss + 0.0001 * self.criterion_cobi_rgb(
-                    output_patches, target_patches
-                )
-            else:
-                loss = self.criterion(output, target)
+            loader_wait += time.perf_counter() - fetch_start
+            loss = self.train_step(data, target)
             train_loss += loss.item()
-            loss.backward()
-            self.optimizer.step()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            fetch_start = time.perf_counter()
 
+        epoch_time = time.perf_counter() - start_time
         print("    Average Loss: {:.4f}".format(train_loss / len(self.training_loader)))
+        self.logger.info(
+            f"loader wait: {loader_wait:.2f} s of {epoch_time:.2f} s "
+            f"({100 * loader_wait / max(epoch_time, 1e-9):.1f}%), "
+            f"num_workers={self.training_loader.num_workers}"
+        )
 
     def validate(self):
         self.model.eval()
@@ -198,9 +272,93 @@ class Trainer(ABC):
             "\nNumber of learnable parameters: {:,}".format(self.count_parameters())
         )
 
+    def measure_step_time(self, batch, num_steps=3):
+        """average seconds of a training step on batch, without an optimizer step so
+        the weights are not changed. The buffers, e.g. BatchNorm running stats
+        updated by the forward passes in train mode, are restored afterwards."""
+        self.model.train()
+        data, target = batch
+        buffers = [b.detach().clone() for b in self.model.buffers()]
+        # first step includes the cudnn benchmark and allocations
+        self.train_step(data, target)
+        if self.CUDA:
+            torch.cuda.synchronize(self.device)
+        start_time = time.perf_counter()
+        for _ in range(num_steps):
+            self.train_step(data, target)
+        if self.CUDA:
+            torch.cuda.synchronize(self.device)
+        step_time = (time.perf_counter() - start_time) / num_steps
+        self.optimizer.zero_grad()
+        with torch.no_grad():
+            for b, saved in zip(self.model.buffers(), buffers):
+                b.copy_(saved)
+        return step_time
+
+    def compare_precision(self, batch, num_steps=5):
+        """step time and peak memory of a training step on batch with the
+        configured precision against fp32, logged at the start of run. On gpu the
+        peak is the allocated memory, on cpu the sampled rss above the rss before
+        the fp32 steps. The cpu allocator can keep memory freed by the fp32 steps,
+        so the cpu peaks are approximate.
+
+        Returns
+        -------
+        {precision: (seconds per step, peak bytes)}
+        """
+        precision = self.precision
+        results = {}
+        rss_baseline = current_rss()
+        for p in dict.fromkeys(("fp32", precision)):
+            self.precision = p
+            if self.CUDA:
+                torch.cuda.empty_cache()
+                torch.cuda.reset_peak_memory_stats(self.device)
+                step_time = self.measure_step_time(batch, num_steps)
+                peak = torch.cuda.max_memory_allocated(self.device)
+            else:
+                with RSSSampler() as sampler:
+                    step_time = self.measure_step_time(batch, num_steps)
+                peak = max(sampler.peak - rss_baseline, 0)
+            results[p] = (step_time, peak)
+            self.logger.info(
+                f"{p} training step: {step_time:.4f} s, peak memory {peak / 1e9:.3f} GB"
+                f"{'' if self.CUDA else ' (rss)'}"
+            )
+        self.precision = precision
+        fp32_time = results["fp32"][0]
+        self.logger.info(
+            f"{precision} speedup over fp32: {fp32_time / results[precision][0]:.2f}x"
+        )
+        return results
+
+    def tune_loaders(self, num_batches=10):
+        """picks the number of loader workers from the decode time of a training
+        batch and the step time, see pick_num_workers, and rebuilds the loaders with
+        it. Called by run with num_workers "auto"."""
+        decode_time, batch = time_loader(
+            rebuild_loader(self.training_loader, num_workers=0), num_batches
+        )
+        step_time = self.measure_step_time(batch)
+        num_workers = pick_num_workers(decode_time, step_time)
+        self.logger.info(
+            f"loader benchmark: decode {decode_time:.4f} s/batch, "
+            f"step {step_time:.4f} s/batch, using {num_workers} workers"
+        )
+        options = dict(self.loader_options, num_workers=num_workers)
+        self.training_loader = rebuild_loader(self.training_loader, **options)
+        self.validation_loader = rebuild_loader(self.validation_loader, **options)
+        self.testing_loader = rebuild_loader(self.testing_loader, **options)
+        self.loader_options = options
+
     def run(self):
         self.build_model()
         self.print_model_summary()
+        if self.loader_options["num_workers"] == "auto":
+            self.tune_loaders()
+        if self.precision != "fp32":
+            batch = next(iter(rebuild_loader(self.training_loader, num_workers=0)))
+            self.compare_precision(batch)
         for epoch in range(1, self.nEpochs + 1):
             print("\n===> Epoch {} starts:".format(epoch))
             self.train()
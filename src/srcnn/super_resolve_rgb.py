@@ -3,31 +3,44 @@ import os
 from datetime import datetime
 import argparse
 import torch
-import torch.backends.cudnn as cudnn
 from PIL import Image
 from torchvision.transforms import ToTensor
 import time
 
 import numpy as np
 
-from src.visualization.plot_utils import inference_plot_and_save
+from src.visualization.plot_utils import inference_plot_and_save, bicubic_baseline
 
 from os import listdir
 from os.path import join
 
 from src.utils.utils import is_image_file
 from src.visualization.plot_utils import calc_avg_metrics
-from src.utils.patch_and_combine import (
-    creates_lr_patches_hr_merge_indices,
-    merge_hr_patches,
-)
+from src.srcnn.tile_engine import TileEngine
+from src.utils.output_store import OutputStore, BaselineCache, file_hash
 
 from src.my_logger import Logger
 
 
 class MixValidation:
     #
-    def __init__(self, paired_data_dir, args=None, patchwise=False, ps=256):
+    def __init__(
+        self,
+        paired_data_dir,
+        args=None,
+        patchwise=False,
+        ps=256,
+        batch_size=4,
+        precision="fp32",
+        channels_last=False,
+        min_precision_psnr=40.0,
+        output_norm="clamp",
+        use_store=True,
+        store_dir=None,
+        baseline_dir=None,
+        overlap=0.2,
+        merge="overwrite",
+    ):
         self.input_dir = join(paired_data_dir, "input_lr")
         self.output_dir = join(paired_data_dir, "output_hr")
 
@@ -61,7 +74,82 @@ class MixValidation:
         self.out_dir = os.path.join(out_dir, t)
         os.makedirs(self.out_dir)
         self.patchwise = patchwise
-        self.ps = ps
+        if not patchwise and ps == "auto":
+            # full images are not tiled, no need to probe the model
+            ps = 256
+        self.engine = TileEngine(
+            self.model,
+            self.device,
+            args.channeltype,
+            ps=ps,
+            batch_size=batch_size,
+            precision=precision,
+            channels_last=channels_last,
+            output_norm=output_norm,
+            scale=getattr(args, "upscale_factor", None),
+            overlap=overlap,
+            merge=merge,
+        )
+        # ps="auto" is resolved by the tile planner, scale=None from the model
+        self.ps = self.engine.ps
+        self.scale = self.engine.scale
+        self.min_precision_psnr = min_precision_psnr
+        # sr outputs and metrics are cached by checkpoint, image pair and tile config
+        self.store = (
+            OutputStore(store_dir or os.path.join(args.save_dir, "output_store"))
+            if use_store
+            else None
+        )
+        self.checkpoint_hash = (
+            file_hash(args.save_dir + "/model_path.pth") if use_store else None
+        )
+        # bicubic images and metrics are shared by all checkpoints
+        if use_store:
+            self.baselines = (
+                BaselineCache(baseline_dir) if baseline_dir else BaselineCache()
+            )
+        else:
+            self.baselines = None
+
+    def store_key(self, lr_path, hr_path):
+        return OutputStore.key(
+            checkpoint=self.checkpoint_hash,
+            input=file_hash(lr_path),
+            gt=file_hash(hr_path),
+            config=self.engine.config(),
+            patchwise=self.patchwise,
+        )
+
+    def figure_path(self, file_base_name):
+        """path of the comparison figure of an image in out_dir"""
+        return (
+            self.out_dir
+            + file_base_name
+            + "compare"
+            + datetime.now().strftime("_%b_%d_%H_%M_%S_%f")
+            + ".png"
+        )
+
+    def bicubic(self, lr_path, hr_path, lr_img=None, gt_img=None):
+        """bicubic hr image of the pair, saved to out_dir, and its metrics from the
+        baseline cache. Returns None without a cache."""
+        if self.baselines is None:
+            return None
+        file_base_name = os.path.splitext(os.path.basename(lr_path))[0]
+
+        def compute():
+            gt = gt_img if gt_img is not None else Image.open(hr_path).convert("RGB")
+            lr = lr_img if lr_img is not None else Image.open(lr_path).convert("RGB")
+            return bicubic_baseline(gt, lr, self.scale)
+
+        return self.baselines.get_or_compute(
+            lr_path,
+            self.scale,
+            "cv2",
+            self.out_dir + file_base_name + "_bicubic_hr.png",
+            compute,
+            gt_path=hr_path,
+        )
 
     @torch.inference_mode(mode=True)
     def validation(self):
@@ -71,7 +159,25 @@ class MixValidation:
         logger_instance.initialize("inference")
         logger = logger_instance.get_logger()
         times = []
+        precision_psnrs = []
         for lr_path, hr_path in zip(self.input_filenames, self.output_filenames):
+            file_base_name = os.path.splitext(os.path.basename(lr_path))[0]
+            if self.store is not None:
+                key = self.store_key(lr_path, hr_path)
+                record = self.store.restore(
+                    key, self.out_dir, prefix=file_base_name + "_"
+                )
+                # entries stored without the figure are computed again
+                if record is not None and "compare.png" in record["files"]:
+                    # the figure gets the name of a fresh run
+                    os.replace(
+                        record["files"]["compare.png"], self.figure_path(file_base_name)
+                    )
+                    logger.info(f"{file_base_name}: sr output, figure and metrics restored")
+                    self.bicubic(lr_path, hr_path)
+                    bicubic_metrics_list.append(tuple(record["metrics"]["bicubic"]))
+                    output_metrics_list.append(tuple(record["metrics"]["output"]))
+                    continue
             start_time = time.perf_counter()
             lr_img = Image.open(lr_path)
             gt_img = Image.open(hr_path)
@@ -82,20 +188,22 @@ class MixValidation:
             if gt_img.mode != "RGB":
                 gt_img = gt_img.convert("RGB")
             if self.patchwise:
-
-                lr_patches, hr_indices = creates_lr_patches_hr_merge_indices(
-                    lr_img, self.ps, scale=2
+                if self.engine.precision != "fp32" and not precision_psnrs:
+                    # low precision output checked against fp32 on the first image
+                    precision_psnrs.append(
+                        self.engine.check_precision(lr_img, self.min_precision_psnr)
+                    )
+                    logger.info(
+                        f"{self.engine.precision} psnr against fp32 output: {precision_psnrs[0]:.2f} dB"
+                    )
+                out_img = self.engine.super_resolve(lr_img)
+                logger.info(
+                    f"{self.engine.stats['patches']} patches, batch size {self.engine.batch_size}: "
+                    f"{self.engine.stats['patches_per_sec']:.2f} patches/sec"
                 )
-                hr_patches = []
-                # ground truth image
-                for img in lr_patches:
-                    out_img = self.single_img_sr(img)
-                    hr_patches.append(out_img)
-                out_img = merge_hr_patches(hr_patches, hr_indices)
             else:
                 out_img = self.single_img_sr(lr_img)
 
-            file_base_name = os.path.splitext(os.path.basename(lr_path))[0]
             out_img.save(self.out_dir + file_base_name + "_sr_hr.png")
             end_time = time.perf_counter()
             print(
@@ -112,13 +220,35 @@ class MixValidation:
             # lr_img.save(self.out_dir + file_base_name+ "_lr.png")
             # breakpoint()
             # print(gt_img, lr_img, out_img)
+            figure_path = self.figure_path(file_base_name)
             a, b = inference_plot_and_save(
-                gt_img, lr_img, out_img, self.out_dir, file_base_name
+                gt_img,
+                lr_img,
+                out_img,
+                self.out_dir,
+                file_base_name,
+                scale=self.scale,
+                baseline=self.bicubic(lr_path, hr_path, lr_img, gt_img),
+                figure_path=figure_path,
             )
             bicubic_metrics_list.append(a)
             output_metrics_list.append(b)
+            if self.store is not None:
+                self.store.put(
+                    key,
+                    {
+                        "sr_hr.png": self.out_dir + file_base_name + "_sr_hr.png",
+                        "compare.png": figure_path,
+                    },
+                    {
+                        "bicubic": [float(m) for m in a],
+                        "output": [float(m) for m in b],
+                    },
+                )
 
-        logger.info(f"avg time :{sum(times)/len(times)}")
+        self.engine.session.close()
+        if times:
+            logger.info(f"avg time :{sum(times)/len(times)}")
         psnr_bicubic, ssim_bicubic, lpips_distance_bicubic = calc_avg_metrics(
             bicubic_metrics_list
         )
@@ -143,16 +273,13 @@ class MixValidation:
         data = (ToTensor()(y)).view(1, -1, y.size[1], y.size[0])
         data = data.to(self.device)
 
-        if GPU_IN_USE:
-            cudnn.benchmark = True
-
         # ===========================================================
         # output and save image
         # ===========================================================
 
         if self.args.channeltype == "y":
 
-            out = self.model(data)
+            out = self.engine.session.forward(data, pad_batch=False, pad_shape=False)
             out = out.cpu()
             out_img_y = out.data[0].numpy()
             out_img_y *= 255.0
@@ -169,7 +296,7 @@ class MixValidation:
             #  output values scaling to 0-255
             # with torch.no_grad():
 
-            out = self.model(data)
+            out = self.engine.session.forward(data, pad_batch=False, pad_shape=False)
             # for param in self.model.parameters():
             #     if param.requires_grad:
             #         print("Gradients are being calculated.")
@@ -181,7 +308,6 @@ class MixValidation:
 
             out_img = Image.fromarray(np.uint8(out_img_y), mode="RGB")
 
-        torch.cuda.empty_cache()
         return out_img
 
     def cuda_prop(self):
@@ -217,6 +343,63 @@ def main():
         default="y",
         help="channels for model. options- y and rgb.",
     )
+    parser.add_argument(
+        "--ps",
+        type=lambda x: x if x == "auto" else int(x),
+        default=256,
+        help="lr patch size, auto probes the model for the patch and batch size with the highest throughput that fits in memory",
+    )
+    parser.add_argument(
+        "--upscale_factor",
+        "-uf",
+        type=int,
+        default=None,
+        help="upscale factor of the model, by default read from the model",
+    )
+    parser.add_argument(
+        "--overlap",
+        type=float,
+        default=0.2,
+        help="overlap of the patches, blended merges need less overlap for the same seams",
+    )
+    parser.add_argument(
+        "--merge",
+        type=str,
+        default="overwrite",
+        choices=["overwrite", "avg", "linear", "spline"],
+        help="merge of overlapping patches: overwrite, average or blend with a linear or spline window. All but overwrite keep float32 buffers of about 5x the uint8 hr image",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=4,
+        help="number of patches per forward pass, ignored with --ps auto",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16", "fp16"],
+        help="autocast precision of the forward pass",
+    )
+    parser.add_argument(
+        "--channels_last",
+        action="store_true",
+        help="run the model in channels_last memory format",
+    )
+    parser.add_argument(
+        "--output_norm",
+        type=str,
+        default="clamp",
+        choices=["clamp", "global", "tile"],
+        help="mapping of model output to uint8: clamp, one min/max stretch per image (global) or per patch (tile)",
+    )
+
+    parser.add_argument(
+        "--no_store",
+        action="store_true",
+        help="recompute all outputs and metrics instead of reusing the ones stored for this checkpoint",
+    )
 
     args = parser.parse_args()
     print(args)
@@ -224,7 +407,17 @@ def main():
         os.getcwd() + "/data/processed/set_3/img_pairs_train_val_test/val/"
     )
     mixvalidate = MixValidation(
-        paired_data_dir=PAIRED_DATA_DIR, args=args, patchwise=True
+        paired_data_dir=PAIRED_DATA_DIR,
+        args=args,
+        patchwise=True,
+        ps=args.ps,
+        batch_size=args.batch_size,
+        precision=args.precision,
+        channels_last=args.channels_last,
+        output_norm=args.output_norm,
+        use_store=not args.no_store,
+        overlap=args.overlap,
+        merge=args.merge,
     )
     mixvalidate.validation()
 
@@ -0,0 +1,46 @@
+import pytest
+import torch
+
+from src.srcnn.dataset.dataset import D4Augmentation
+
+test_shape = [4, 3, 6, 6]
+
+
+def upscale(x, scale=2):
+    return x.repeat_interleave(scale, dim=-2).repeat_interleave(scale, dim=-1)
+
+
+@pytest.mark.parametrize("same_on_batch", [True, False])
+def test_input_and_target_stay_aligned(same_on_batch):
+    augment = D4Augmentation(same_on_batch=same_on_batch)
+    data = torch.rand(*test_shape)
+    target = upscale(data)
+    for _ in range(20):
+        aug_data, aug_target = augment(data, target)
+        assert torch.equal(aug_target, upscale(aug_data))
+
+
+def test_transforms_are_exact_permutations():
+    augment = D4Augmentation()
+    data = torch.rand(*test_shape)
+    for _ in range(20):
+        aug_data, _ = augment(data, upscale(data))
+        assert torch.equal(
+            aug_data.flatten(1).sort(dim=1).values, data.flatten(1).sort(dim=1).values
+        )
+
+
+def test_all_transforms_are_drawn():
+    data = torch.arange(16.0).reshape(1, 1, 4, 4)
+    seen = set()
+    for _ in range(200):
+        aug_data, _ = D4Augmentation()(data, data)
+        seen.add(tuple(aug_data.flatten().tolist()))
+    assert len(seen) == 8
+
+
+def test_apply_of_non_square_batch():
+    data = torch.rand(2, 1, 3, 5)
+    for k in range(8):
+        shape = D4Augmentation.apply(data, k).shape[-2:]
+        assert shape == ((3, 5) if k % 2 == 0 else (5, 3))
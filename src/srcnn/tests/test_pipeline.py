@@ -0,0 +1,41 @@
+import threading
+
+import pytest
+
+from src.srcnn.pipeline import run_pipeline
+
+items = list(range(20))
+
+
+def test_all_items_pass_all_stages():
+    encoded = {}
+    lock = threading.Lock()
+
+    def encode(item, result):
+        with lock:
+            encoded[item] = result
+
+    timer = run_pipeline(
+        items,
+        decode=lambda item: item * 2,
+        compute=lambda item, decoded: decoded + 1,
+        encode=encode,
+        decode_queue_depth=2,
+        encode_queue_depth=2,
+    )
+    assert encoded == {item: item * 2 + 1 for item in items}
+    assert timer.summary()["compute"][0] == len(items)
+
+
+@pytest.mark.parametrize("stage", ["decode", "compute", "encode"])
+def test_errors_are_raised(stage):
+    def fail(name):
+        def func(item, *args):
+            if name == stage and item == 5:
+                raise ValueError(f"{name} failed")
+            return item
+
+        return func
+
+    with pytest.raises(ValueError, match=f"{stage} failed"):
+        run_pipeline(items, fail("decode"), fail("compute"), fail("encode"))
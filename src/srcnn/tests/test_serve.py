@@ -0,0 +1,65 @@
+import threading
+
+import numpy as np
+
+from src.srcnn.serve import TileBatcher
+
+scale = 2
+
+
+class UpscalingEngine:
+    # the parts of TileEngine the batcher uses, nearest upscaling of uint8 patches
+    ps = 8
+    batch_size = 4
+    scale = scale
+
+    def __init__(self):
+        self.batch_shapes = []
+
+    def forward_batch(self, batch):
+        self.batch_shapes.append(batch.shape)
+        return batch.repeat(scale, axis=1).repeat(scale, axis=2)
+
+
+def test_mixed_size_patches_are_cropped():
+    engine = UpscalingEngine()
+    batcher = TileBatcher(engine, max_latency=0.05)
+    shapes = [(8, 8), (5, 8), (3, 2), (8, 1)]
+    batches = [np.random.randint(0, 256, (2, h, w, 3), dtype=np.uint8) for h, w in shapes]
+    results = [None] * len(batches)
+
+    def submit(i):
+        results[i] = batcher.submit(batches[i])
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(batches))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    batcher.close()
+
+    for batch, result in zip(batches, results):
+        np.testing.assert_array_equal(
+            result, batch.repeat(scale, axis=1).repeat(scale, axis=2)
+        )
+    # all patches were padded to the tile size and no batch was over the batch size
+    for shape in engine.batch_shapes:
+        assert shape[0] <= engine.batch_size
+        assert shape[1:3] == (engine.ps, engine.ps)
+    assert batcher.timer.summary()["batch_wait"][0] == 2 * len(shapes)
+
+
+def test_errors_reach_the_caller():
+    class FailingEngine(UpscalingEngine):
+        def forward_batch(self, batch):
+            raise RuntimeError("forward failed")
+
+    batcher = TileBatcher(FailingEngine())
+    try:
+        batcher.submit(np.zeros((1, 8, 8, 3), dtype=np.uint8))
+    except RuntimeError as e:
+        assert "forward failed" in str(e)
+    else:
+        raise AssertionError("no error raised")
+    finally:
+        batcher.close()
@@ -0,0 +1,66 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from src.srcnn.dataset.dataset import PairedDatasetFromFolder
+from src.srcnn.dataset.paired_data import input_transform, target_transform
+from src.srcnn.dataset.shards import (
+    ShardDataset,
+    pack_paired_shard,
+    shard_is_current,
+)
+
+upscale_factor = 2
+crop_size = 32
+
+
+def make_paired_dir(root, num_pairs=3):
+    os.makedirs(os.path.join(root, "input_lr"))
+    os.makedirs(os.path.join(root, "output_hr"))
+    for i in range(num_pairs):
+        hr = np.random.randint(0, 256, (40 + 2 * i, 48, 3), dtype=np.uint8)
+        lr = hr[::upscale_factor, ::upscale_factor]
+        Image.fromarray(lr).save(os.path.join(root, "input_lr", f"{i}.png"))
+        Image.fromarray(hr).save(os.path.join(root, "output_hr", f"{i}.png"))
+    return root
+
+
+@pytest.mark.parametrize("channeltype", ["y", "rgb"])
+def test_shard_matches_folder_dataset(tmp_path, channeltype):
+    paired_dir = make_paired_dir(str(tmp_path / "train"))
+    path = str(tmp_path / "train_shard")
+    n = pack_paired_shard(paired_dir, path, channeltype, upscale_factor, crop_size)
+
+    folder = PairedDatasetFromFolder(
+        paired_dir,
+        input_transform=input_transform(crop_size, upscale_factor),
+        target_transform=target_transform(crop_size),
+        channeltype=channeltype,
+    )
+    shard = ShardDataset(path)
+    assert n == len(shard) == len(folder)
+    for i in range(len(folder)):
+        for expected, item in zip(folder[i], shard[i]):
+            assert item.dtype == expected.dtype
+            assert torch.equal(item, expected)
+
+
+def test_shard_is_stale_after_folder_changes(tmp_path):
+    paired_dir = make_paired_dir(str(tmp_path / "train"))
+    path = str(tmp_path / "train_shard")
+    assert not shard_is_current(path, paired_dir)
+    pack_paired_shard(paired_dir, path, "y", upscale_factor, crop_size)
+    assert shard_is_current(path, paired_dir)
+
+    hr = np.zeros((40, 48, 3), dtype=np.uint8)
+    Image.fromarray(hr).save(os.path.join(paired_dir, "output_hr", "0.png"))
+    assert not shard_is_current(path, paired_dir)
+    pack_paired_shard(paired_dir, path, "y", upscale_factor, crop_size)
+    assert shard_is_current(path, paired_dir)
+
+    os.remove(os.path.join(paired_dir, "input_lr", "2.png"))
+    os.remove(os.path.join(paired_dir, "output_hr", "2.png"))
+    assert not shard_is_current(path, paired_dir)
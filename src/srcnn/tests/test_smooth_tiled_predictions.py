@@ -0,0 +1,51 @@
+import numpy as np
+
+from src.srcnn.smooth_tiled_predictions import predict_img_with_smooth_windowing
+
+window_size = 8
+subdivisions = 2
+
+
+def pred_func(batch):
+    # per window, but not per pixel, so misplaced windows change the output
+    return np.tanh(batch) * 2 + batch.mean(axis=(1, 2, 3), keepdims=True)
+
+
+def test_batched_accumulate_matches_5d_path():
+    img = np.random.rand(13, 11, 3)
+    expected = predict_img_with_smooth_windowing(
+        img, window_size, subdivisions, nb_classes=3, pred_func=pred_func
+    )
+    for batch_size in (1, 3, 1000):
+        result = predict_img_with_smooth_windowing(
+            img,
+            window_size,
+            subdivisions,
+            nb_classes=3,
+            pred_func=pred_func,
+            batch_size=batch_size,
+        )
+        np.testing.assert_array_equal(result, expected)
+
+
+def test_tile_ensemble_matches_8_rotations():
+    # sides of a multiple of the window step, so the windows of the rotated padded
+    # images are the windows of the image itself. pred_func is D4-equivariant (the
+    # window mean does not change under flips and rotations), so both ensembles
+    # average the same predictions
+    img = np.random.rand(12, 16, 3)
+    expected = predict_img_with_smooth_windowing(
+        img, window_size, subdivisions, nb_classes=3, pred_func=pred_func
+    )
+    for batch_size in (1, 4):
+        result = predict_img_with_smooth_windowing(
+            img,
+            window_size,
+            subdivisions,
+            nb_classes=3,
+            pred_func=pred_func,
+            batch_size=batch_size,
+            tile_ensemble="mean",
+        )
+        assert result.shape == img.shape
+        np.testing.assert_allclose(result, expected, rtol=1e-10, atol=1e-12)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import torch
+
+from src.srcnn.tile_engine import TileEngine
+from src.utils.patch_and_combine import (
+    creates_lr_patches_hr_merge_indices,
+    merge_hr_patches,
+)
+
+ps = 16
+scale = 2
+
+
+def make_engine(batch_size, **kwargs):
+    # nearest upscaling, so every output pixel only depends on its lr pixel
+    model = torch.nn.Upsample(scale_factor=scale, mode="nearest").eval()
+    return TileEngine(
+        model, torch.device("cpu"), "rgb", ps=ps, batch_size=batch_size, **kwargs
+    )
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 4])
+def test_batched_matches_per_patch_path(batch_size):
+    lr = np.random.randint(0, 256, (37, 53, 3), dtype=np.uint8)
+    engine = make_engine(batch_size)
+    assert engine.scale == scale
+
+    # one forward pass per patch, merged by the helpers the engine replaced
+    lr_patches, hr_indices = creates_lr_patches_hr_merge_indices(
+        lr, ps, scale=scale, as_array=True, overlap=engine.overlap
+    )
+    hr_patches = [engine.forward_batch(p[np.newaxis])[0] for p in lr_patches]
+    expected = np.array(merge_hr_patches(hr_patches, hr_indices))
+
+    result = engine.super_resolve_array(lr)
+    np.testing.assert_array_equal(result, expected)
+    assert engine.stats["patches"] == len(lr_patches)
+    # uint8 -> float -> uint8 may round down by one
+    upscaled = lr.repeat(scale, axis=0).repeat(scale, axis=1).astype(int)
+    assert np.abs(result.astype(int) - upscaled).max() <= 1
+
+
+def test_image_smaller_than_tile():
+    lr = np.random.randint(0, 256, (5, 9, 3), dtype=np.uint8)
+    result = make_engine(4).super_resolve_array(lr)
+    assert result.shape == (5 * scale, 9 * scale, 3)
@@ -0,0 +1,34 @@
+import json
+
+import torch
+
+from src.srcnn.tile_planner import model_signature, plan_tiles
+
+tile_sizes = (8, 16)
+batch_sizes = (1, 2)
+
+
+def test_model_signature_depends_on_configuration():
+    a = torch.nn.Conv2d(3, 8, 3)
+    assert model_signature(a) == model_signature(torch.nn.Conv2d(3, 8, 3))
+    assert model_signature(a) != model_signature(torch.nn.Conv2d(3, 16, 3))
+
+
+def test_plan_is_probed_once_and_cached(tmp_path):
+    model = torch.nn.Conv2d(3, 3, 3, padding=1).eval()
+    cache_path = str(tmp_path / "plans.json")
+    plan = plan_tiles(
+        model,
+        "cpu",
+        num_channels=3,
+        architecture="test_planner",
+        tile_sizes=tile_sizes,
+        batch_sizes=batch_sizes,
+        cache_path=cache_path,
+    )
+    assert plan["tile"] in tile_sizes
+    assert plan["batch_size"] in batch_sizes
+    assert plan["overlap"] == 0.2
+    with open(cache_path) as f:
+        assert plan in json.load(f).values()
+    assert plan_tiles(model, "cpu", 3, architecture="test_planner") == plan
@@ -0,0 +1,340 @@
+import threading
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from src.utils.patch_and_combine import lr_patch_views_hr_indices
+from src.utils.scripts.empatches_0 import PatchMerger, linear_window
+from src.srcnn.smooth_tiled_predictions import _spline_window
+from src.srcnn.session import InferenceSession
+from src.srcnn.tile_planner import plan_tiles
+
+
+# clamp: clamp and quantise each patch on the device, no statistics
+# global: one min/max stretch over the merged float image
+# tile: min/max stretch per patch, as MixValidation.single_img_sr does per image
+# for rgb
+OUTPUT_NORMS = ["clamp", "global", "tile"]
+
+# overwrite: later patches overwrite the overlap of earlier ones
+# avg: overlaps are averaged
+# linear, spline: overlaps are blended with a linear ramp or the squared spline
+# window of smooth_tiled_predictions, so smaller overlaps give no visible seams
+MERGE_MODES = {
+    "overwrite": {"mode": "overwrite"},
+    "avg": {"mode": "avg"},
+    "linear": {"mode": "blend", "window": linear_window},
+    "spline": {"mode": "blend", "window": _spline_window},
+}
+
+
+class TileEngine:
+    """patch-wise SR of large images. LR patches are stacked into batches, each batch
+    is a single forward pass and the SR patches are written straight into the HR canvas.
+    The forward passes go through an InferenceSession with (ps, ps) tiles and
+    batch_size as the canonical shape, so edge batches and patches of images smaller
+    than ps are padded to it.
+
+    Parameters
+    ----------
+    model : SR model, already on device and in eval mode
+    device : torch.device
+    channeltype : str
+        channels of the model, y or rgb
+    ps : int or str, optional
+        lr patch size, by default 256. "auto" picks patch and batch size with the
+        highest throughput that fits in memory, see plan_tiles
+    batch_size : int, optional
+        number of patches per forward pass, by default 4
+    overlap : float, optional
+        overlap of the patches, by default 0.2
+    scale : int, optional
+        upscale factor of the model, by default read from the model with one
+        forward pass of a small input
+    precision : str, optional
+        fp32, bf16 or fp16 autocast for the forward pass, by default "fp32".
+        bf16 also works on cpu
+    channels_last : bool, optional
+        run the model and patches in channels_last memory format, by default False
+    output_norm : str, optional
+        mapping of the model output to uint8, one of OUTPUT_NORMS, by default "clamp".
+        global keeps a float copy of the hr image until the end of the image
+    merge : str, optional
+        merge of the overlapping patches, one of MERGE_MODES, by default "overwrite".
+        All but overwrite keep a float32 accumulator and weight map of the hr image,
+        about 5 times the uint8 hr image, see PatchMerger
+    architecture : str, optional
+        name of the model for the cached tile plans, by default its class name
+    """
+
+    def __init__(
+        self,
+        model,
+        device,
+        channeltype,
+        ps=256,
+        batch_size=4,
+        scale=None,
+        precision="fp32",
+        channels_last=False,
+        output_norm="clamp",
+        overlap=0.2,
+        architecture=None,
+        merge="overwrite",
+    ):
+        if output_norm not in OUTPUT_NORMS:
+            raise ValueError(
+                f"output_norm has to be either one of {OUTPUT_NORMS}, but got {output_norm}"
+            )
+        if merge not in MERGE_MODES:
+            raise ValueError(
+                f"merge has to be either one of {list(MERGE_MODES)}, but got {merge}"
+            )
+        if ps == "auto":
+            plan = plan_tiles(
+                model,
+                device,
+                num_channels=1 if channeltype == "y" else 3,
+                architecture=architecture,
+                precision=precision,
+                channels_last=channels_last,
+                overlap=overlap,
+            )
+            ps, batch_size, overlap = plan["tile"], plan["batch_size"], plan["overlap"]
+        self.session = InferenceSession(
+            model,
+            device,
+            precision=precision,
+            channels_last=channels_last,
+            tile_shapes=[(ps, ps)],
+            batch_size=batch_size,
+        )
+        self.device = self.session.device
+        self.channeltype = channeltype
+        self.ps = ps
+        self.batch_size = batch_size
+        self.overlap = overlap
+        self.scale = scale or self.session.upscale_factor(
+            1 if channeltype == "y" else 3
+        )
+        self.output_norm = output_norm
+        self.merge = merge
+        # throughput of the last super_resolve call of each thread, so concurrent
+        # calls, e.g. the requests of src.srcnn.serve, do not mix their stats
+        self._local = threading.local()
+
+    @property
+    def stats(self):
+        """throughput of the last super_resolve call of the calling thread"""
+        return getattr(self._local, "stats", {})
+
+    def config(self):
+        """settings which change the output, e.g. for keys of cached outputs"""
+        return {
+            "channeltype": self.channeltype,
+            "ps": self.ps,
+            "overlap": self.overlap,
+            "scale": self.scale,
+            "precision": self.precision,
+            "output_norm": self.output_norm,
+            "merge": self.merge,
+        }
+
+    @property
+    def precision(self):
+        return self.session.precision
+
+    @precision.setter
+    def precision(self, precision):
+        self.session.precision = precision
+
+    @torch.inference_mode(mode=True)
+    def super_resolve(self, lr_img, forward=None):
+        """super-resolves a PIL image patch-wise and returns the merged PIL image,
+        forward as in super_resolve_array"""
+        if lr_img.mode != "RGB":
+            lr_img = lr_img.convert("RGB")
+        if self.channeltype == "y":
+            # only the Y plane is tiled, the colour conversion and the chroma
+            # upscaling are done once for the whole image
+            y, cb, cr = lr_img.convert("YCbCr").split()
+            y_hr = self.super_resolve_array(
+                np.array(y)[..., np.newaxis], forward=forward
+            )
+            size = (y_hr.shape[1], y_hr.shape[0])
+            return Image.merge(
+                "YCbCr",
+                [
+                    Image.fromarray(y_hr[..., 0], mode="L"),
+                    cb.resize(size, Image.BICUBIC),
+                    cr.resize(size, Image.BICUBIC),
+                ],
+            ).convert("RGB")
+
+        hr_img = self.super_resolve_array(np.array(lr_img), forward=forward)
+        return Image.fromarray(hr_img, mode="RGB")
+
+    @torch.inference_mode(mode=True)
+    def super_resolve_array(self, lr, out=None, forward=None):
+        """super-resolves a uint8 array patch-wise. Patches are sliced from lr batch
+        by batch, so lr can be a np.memmap which is never loaded completely.
+
+        Parameters
+        ----------
+        lr : np.ndarray
+            (H, W, 3) RGB lr image, or (H, W, 1) Y plane for channeltype y. For an
+            RGB image and channeltype y, colour conversion and chroma upscaling are
+            done per patch, which keeps memory bounded for memory-mapped images.
+        out : np.ndarray, optional
+            (H*scale, W*scale, C) uint8 buffer for the hr image, e.g. a np.memmap,
+            by default allocated here
+        forward : function, optional
+            runs a batch of lr patches like forward_batch, by default forward_batch.
+            E.g. TileBatcher.submit of src.srcnn.serve, which batches the patches of
+            several images
+
+        Returns
+        -------
+        the hr image as uint8 np array (out if given), Y plane for a Y plane input
+        else RGB
+        """
+        # patches are gathered batch by batch from a strided view of lr
+        windows, offsets, hr_indices = lr_patch_views_hr_indices(
+            lr, self.ps, scale=self.scale, overlap=self.overlap
+        )
+        # last index covers the bottom right corner of the image
+        hr_h, hr_w = hr_indices[-1][1], hr_indices[-1][3]
+        if self.output_norm == "global" and self.channeltype == "y" and lr.shape[-1] == 3:
+            raise ValueError("global output_norm needs the Y plane as input for channeltype y")
+        if out is None:
+            out = np.zeros((hr_h, hr_w, lr.shape[-1]), dtype=np.uint8)
+        if self.output_norm == "global":
+            merger = PatchMerger(
+                shape=out.shape, dtype=np.float32, **MERGE_MODES[self.merge]
+            )
+        else:
+            merger = PatchMerger(out=out, **MERGE_MODES[self.merge])
+
+        forward = forward or self.forward_batch
+        start_time = time.perf_counter()
+        for i in range(0, len(offsets), self.batch_size):
+            oy, ox = offsets[i : i + self.batch_size].T
+            # one gather copy of (N, C, h, w), the NHWC view of it goes to torch as is
+            batch = windows[oy, ox].transpose(0, 2, 3, 1)
+            if self.channeltype == "y" and batch.shape[-1] == 3:
+                batch = np.stack(
+                    [np.array(Image.fromarray(p).convert("YCbCr")) for p in batch]
+                )
+            hr_patches = forward(batch)
+            merger.add(hr_patches, hr_indices[i : i + self.batch_size])
+        if self.output_norm == "global":
+            # one reduction for the whole image
+            hr = merger.result()
+            lo, hi = hr.min(), hr.max()
+            hr -= lo
+            hr *= 255.0 / (hi - lo) if hi > lo else 0.0
+            out[...] = hr
+        else:
+            merger.result()
+        elapsed = time.perf_counter() - start_time
+
+        self._local.stats = {
+            "patches": len(offsets),
+            "batch_size": self.batch_size,
+            "seconds": elapsed,
+            "patches_per_sec": len(offsets) / elapsed if elapsed > 0 else 0.0,
+        }
+        return out
+
+    def forward_batch(self, batch):
+        """runs the model on a batch of lr patches
+
+        Parameters
+        ----------
+        batch : np.ndarray
+            uint8 array of shape (N, H, W, C). For channeltype y either the Y plane
+            (C = 1) or YCbCr (C = 3), else RGB
+
+        Returns
+        -------
+        np array of shape (N, H*scale, W*scale, C), Y plane for a Y plane batch
+        else RGB. uint8, or the float model output for output_norm global
+        """
+        if self.channeltype == "y":
+            data = torch.from_numpy(np.ascontiguousarray(batch[..., :1]))
+        else:
+            data = torch.from_numpy(batch)
+        data = data.to(self.device).permute(0, 3, 1, 2).float().div(255.0)
+        out = self.session.forward(data)
+        if out.shape[2] != data.shape[2] * self.scale:
+            raise ValueError(
+                f"model upscales by {out.shape[2] / data.shape[2]:g}, but the engine scale is {self.scale}"
+            )
+
+        if self.output_norm == "global":
+            return out.permute(0, 2, 3, 1).cpu().numpy()
+        if self.output_norm == "tile":
+            lo = out.amin(dim=(1, 2, 3), keepdim=True)
+            hi = out.amax(dim=(1, 2, 3), keepdim=True)
+            # flat patches become zero, as the global stretch of a flat image
+            out = (out - lo) / (hi - lo).clamp_min(1e-12)
+        # clamp and quantise on the device, only uint8 is copied to the host
+        out = out.mul(255.0).clamp_(0, 255).to(torch.uint8)
+        out = out.permute(0, 2, 3, 1).cpu().numpy()
+
+        if self.channeltype == "y":
+            out_y = out
+            if batch.shape[-1] == 1:
+                return out_y
+            # chroma of YCbCr patches upscaled per patch
+            hr_patches = []
+            for lr_patch, out_patch_y in zip(batch, out_y):
+                out_img_y = Image.fromarray(out_patch_y[..., 0], mode="L")
+                out_img_cb = Image.fromarray(lr_patch[..., 1], mode="L").resize(
+                    out_img_y.size, Image.BICUBIC
+                )
+                out_img_cr = Image.fromarray(lr_patch[..., 2], mode="L").resize(
+                    out_img_y.size, Image.BICUBIC
+                )
+                out_img = Image.merge(
+                    "YCbCr", [out_img_y, out_img_cb, out_img_cr]
+                ).convert("RGB")
+                hr_patches.append(np.array(out_img))
+            return np.stack(hr_patches)
+        return out
+
+    @torch.inference_mode(mode=True)
+    def check_precision(self, lr_img, min_psnr=40.0):
+        """PSNR of the output at the engine precision against the fp32 output.
+
+        Parameters
+        ----------
+        lr_img : PIL image
+        min_psnr : float, optional
+            tolerance in dB, by default 40.0
+
+        Returns
+        -------
+        psnr in dB, inf if outputs are identical
+
+        Raises
+        ------
+        ValueError if the psnr is below min_psnr
+        """
+        precision = self.precision
+        try:
+            self.precision = "fp32"
+            ref = np.asarray(self.super_resolve(lr_img), dtype=np.float64)
+        finally:
+            self.precision = precision
+        out = np.asarray(self.super_resolve(lr_img), dtype=np.float64)
+
+        mse = np.mean((ref - out) ** 2)
+        psnr = 10 * np.log10(255.0**2 / mse) if mse > 0 else float("inf")
+        if psnr < min_psnr:
+            raise ValueError(
+                f"{precision} output differs from fp32 output, psnr {psnr:.2f} dB < {min_psnr} dB"
+            )
+        return psnr
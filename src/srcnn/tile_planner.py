@@ -0,0 +1,220 @@
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import torch
+
+from src.srcnn.session import InferenceSession
+
+
+TILE_SIZES = (64, 128, 256, 384, 512, 768, 1024)
+BATCH_SIZES = (1, 2, 4, 8, 16)
+# in the logs dir of the project, not of the working dir of the run
+PLAN_CACHE = str(Path(__file__).resolve().parents[2] / "logs" / "tile_plans.json")
+
+# plans already probed in this process, keyed as in the cache file
+_plans = {}
+
+
+def available_memory(device):
+    """free memory in bytes on the device, for cpu the available physical memory"""
+    device = torch.device(device)
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device=device)
+        return free
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+
+def current_rss():
+    # resident set size of this process, from /proc on linux
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class RSSSampler:
+    """samples the rss of the process in a thread, as the cpu allocator has no peak
+    statistics and ru_maxrss is the peak of the whole process lifetime"""
+
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def _probe(session, num_channels, tile, batch_size, rss_baseline=0, repeats=2):
+    """runs one config and returns (seconds per forward, peak memory in bytes). On
+    cpu the peak is the sampled rss above rss_baseline, the rss before all probes"""
+    data = torch.rand(batch_size, num_channels, tile, tile, device=session.device)
+    cuda = session.device.type == "cuda"
+    if cuda:
+        torch.cuda.synchronize(session.device)
+        torch.cuda.reset_peak_memory_stats(session.device)
+        sampler = contextlib.nullcontext()
+    else:
+        sampler = RSSSampler()
+
+    with sampler:
+        # warm up, e.g. cudnn autotuning for the shape
+        session.forward(data, pad_batch=False)
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            session.forward(data, pad_batch=False)
+        if cuda:
+            torch.cuda.synchronize(session.device)
+        seconds = (time.perf_counter() - start_time) / repeats
+
+    if cuda:
+        peak = torch.cuda.max_memory_allocated(session.device)
+    else:
+        peak = max(sampler.peak - rss_baseline, 0)
+    return seconds, peak
+
+
+def model_signature(model):
+    """hash of the layers and parameter shapes of a model, so cached plans are not
+    reused for a model of the same class with another configuration"""
+    h = hashlib.sha256(repr(model).encode())
+    for name, param in model.state_dict().items():
+        h.update(f"{name}:{tuple(param.shape)}:{param.dtype}".encode())
+    return h.hexdigest()[:16]
+
+
+def plan_tiles(
+    model,
+    device,
+    num_channels,
+    architecture=None,
+    precision="fp32",
+    channels_last=False,
+    memory_budget=None,
+    overlap=0.2,
+    tile_sizes=TILE_SIZES,
+    batch_sizes=BATCH_SIZES,
+    cache_path=PLAN_CACHE,
+):
+    """finds the tile and batch size with the highest throughput for a model within
+    a memory budget. Tiles and batches are probed with increasing size until they
+    run out of memory or exceed the budget. Before a config is run its memory is
+    extrapolated from the probed ones (memory per input pixel), and it is skipped if
+    that exceeds the budget, as on cpu the OOM killer ends the process instead of
+    raising an error. Plans are cached per architecture, model configuration, input
+    channels, device type, precision, memory format and overlap, in this process
+    and in cache_path.
+
+    Parameters
+    ----------
+    model : SR model, already on device and in eval mode
+    device : torch.device
+    num_channels : int
+        input channels of the model, 1 for y and 3 for rgb
+    architecture : str, optional
+        name for the cache, by default the class name of the model. The layers
+        and parameter shapes of the model are part of the cache key as well
+    memory_budget : int, optional
+        bytes, by default 80% of the memory available on the device
+    overlap : float, optional
+        overlap of the tiles, by default 0.2. It is not planned but passed through
+        to the plan, it is used to rank configs by new pixels per second
+    cache_path : str, optional
+        json file of the cached plans, None to not use a file
+
+    Returns
+    -------
+    dict with tile, batch_size, overlap and the measured pixels_per_sec and peak_memory
+    """
+    device = torch.device(device)
+    architecture = architecture or type(model).__name__
+    key = (
+        f"{architecture}_{model_signature(model)}_{num_channels}ch_{device.type}"
+        f"_{precision}_{'cl' if channels_last else 'cf'}_overlap{overlap}"
+    )
+
+    if key not in _plans and cache_path and os.path.isfile(cache_path):
+        with open(cache_path) as f:
+            _plans.update(json.load(f))
+    if key in _plans:
+        return _plans[key]
+
+    if memory_budget is None:
+        memory_budget = 0.8 * available_memory(device)
+    session = InferenceSession(
+        model, device, precision=precision, channels_last=channels_last
+    )
+
+    best = None
+    # memory before all probes, on cuda the weights, on cpu the rss of the process
+    if device.type == "cuda":
+        baseline = torch.cuda.memory_allocated(device)
+        rss_baseline = 0
+    else:
+        baseline = 0
+        rss_baseline = current_rss()
+    # bytes per input pixel above the baseline of the last probe, to extrapolate the
+    # next config. Fixed overheads make it decrease with size, so it is not lower
+    # than the one of a larger config
+    bytes_per_pixel = 0.0
+    with torch.inference_mode():
+        for tile in tile_sizes:
+            fits = False
+            for batch_size in batch_sizes:
+                pixels = batch_size * tile * tile
+                if baseline + bytes_per_pixel * pixels > memory_budget:
+                    break
+                try:
+                    seconds, peak = _probe(
+                        session, num_channels, tile, batch_size, rss_baseline
+                    )
+                except RuntimeError as e:
+                    # cuda and cpu allocators raise RuntimeError subclasses
+                    if "out of memory" not in str(e).lower():
+                        raise
+                    if device.type == "cuda":
+                        torch.cuda.empty_cache()
+                    break
+                bytes_per_pixel = max(peak - baseline, 0) / pixels
+                if peak > memory_budget:
+                    break
+                fits = True
+                # new (non overlapping) pixels per second
+                pixels_per_sec = batch_size * (tile * (1 - overlap)) ** 2 / seconds
+                if best is None or pixels_per_sec > best["pixels_per_sec"]:
+                    best = {
+                        "tile": tile,
+                        "batch_size": batch_size,
+                        "overlap": overlap,
+                        "pixels_per_sec": pixels_per_sec,
+                        "peak_memory": peak,
+                    }
+            if not fits:
+                break
+    session.close()
+
+    if best is None:
+        raise RuntimeError(
+            f"no tile size of {list(tile_sizes)} fits the memory budget of {memory_budget / 1e9:.2f} GB"
+        )
+
+    _plans[key] = best
+    if cache_path:
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        with open(cache_path, mode="w") as f:
+            json.dump(_plans, f, indent=2)
+    return best
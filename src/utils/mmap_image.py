@@ -0,0 +1,61 @@
+import numpy as np
+from PIL import Image
+
+
+# raw images are stored as .npy files of shape (H, W, 3) uint8, so they can be
+# memory-mapped and only the pages of the tiles that are read get loaded
+
+
+def open_lr_memmap(npy_path):
+    """opens a raw (H, W, 3) uint8 .npy image read-only as a memory map
+
+    Parameters
+    ----------
+    npy_path : str or Path
+    """
+    lr = np.load(npy_path, mmap_mode="r")
+    if lr.ndim != 3 or lr.dtype != np.uint8:
+        raise ValueError(
+            f"expected a (H, W, C) uint8 image in {npy_path}, but got {lr.shape} {lr.dtype}"
+        )
+    return lr
+
+
+def create_hr_memmap(npy_path, shape):
+    """creates a zero-filled (H, W, 3) uint8 .npy memory map to merge the SR patches into
+
+    Parameters
+    ----------
+    npy_path : str or Path
+    shape : tuple
+        (H, W, C) of the hr image
+    """
+    return np.lib.format.open_memmap(
+        npy_path, mode="w+", dtype=np.uint8, shape=tuple(shape)
+    )
+
+
+def image_to_memmap(image_path, npy_path, band_rows=1024):
+    """converts an image file once into a raw .npy image for memory-mapped tiling.
+    Rows are copied band by band, but PIL decodes compressed formats (jpg, png)
+    completely, so the conversion itself needs the decoded frame in memory once.
+
+    Parameters
+    ----------
+    image_path : str or Path
+    npy_path : str or Path
+    band_rows : int, optional
+        rows copied per step, by default 1024
+    """
+    # stitched scans are larger than the PIL decompression bomb limit
+    Image.MAX_IMAGE_PIXELS = None
+    with Image.open(image_path) as img:
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        w, h = img.size
+        out = create_hr_memmap(npy_path, (h, w, 3))
+        for y in range(0, h, band_rows):
+            band = img.crop((0, y, w, min(y + band_rows, h)))
+            out[y : y + band.size[1]] = np.asarray(band)
+        out.flush()
+    return npy_path
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+from PIL import Image
+
+
+# default dirs are in the project, not in the working dir of the run
+project_dir = Path(__file__).resolve().parents[2]
+
+# file hashes of this process, keyed by (path, size, mtime) so changed files are rehashed
+_hashes = {}
+_hashes_lock = threading.Lock()
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """sha256 hex digest of a file, read in chunks"""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    with _hashes_lock:
+        if memo_key in _hashes:
+            return _hashes[memo_key]
+    h = hashlib.sha256()
+    with open(path, mode="rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            h.update(block)
+    digest = h.hexdigest()
+    with _hashes_lock:
+        _hashes[memo_key] = digest
+    return digest
+
+
+def _tmp_path(dst):
+    # unique per process and thread, as the encode threads of a pipeline store and
+    # restore concurrently, in the dir of dst so os.replace does not cross devices
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(dst) or ".", prefix=os.path.basename(dst) + ".", suffix=".tmp"
+    )
+    os.close(fd)
+    return tmp_path
+
+
+def _copy(src, dst):
+    # copies, not hard links: outputs are written in place (PIL save, np.memmap), which
+    # would change a linked store entry as well
+    tmp_path = _tmp_path(dst)
+    shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class OutputStore:
+    """content-addressed store of outputs and metrics. An entry is a dir named by the
+    hash of its key (e.g. checkpoint hash, input hash and tile config) holding the
+    output files and a record.json with their names and the metrics, so a rerun on
+    unchanged inputs can reuse them instead of computing them again. Files are
+    stored under generic names (e.g. sr_hr.png) as the same content can come from
+    inputs of different names.
+
+    Parameters
+    ----------
+    root : str
+        dir of the store, created if needed
+    """
+
+    RECORD_FILE = "record.json"
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(**parts):
+        """hash of the json of the key parts"""
+        return hashlib.sha256(
+            json.dumps(parts, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """record dict of key with "files" ({name: path in the store}) and "metrics",
+        None if key is not stored or a file of it is missing"""
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, self.RECORD_FILE)) as f:
+                record = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        files = {name: os.path.join(entry_dir, name) for name in record["files"]}
+        if not all(os.path.isfile(p) for p in files.values()):
+            return None
+        record["files"] = files
+        return record
+
+    def put(self, key, files=None, metrics=None):
+        """stores the files ({name: path}) and metrics (json serialisable) under key.
+        The record is written last, so an interrupted put is not seen by get."""
+        files = files or {}
+        entry_dir = self._entry_dir(key)
+        os.makedirs(entry_dir, exist_ok=True)
+        for name, path in files.items():
+            _copy(path, os.path.join(entry_dir, name))
+        record = {"files": sorted(files), "metrics": metrics}
+        tmp_path = _tmp_path(os.path.join(entry_dir, self.RECORD_FILE))
+        with open(tmp_path, mode="w") as f:
+            json.dump(record, f, indent=2)
+        os.replace(tmp_path, os.path.join(entry_dir, self.RECORD_FILE))
+
+    def restore(self, key, out_dir, prefix=""):
+        """copies the files of key into out_dir as prefix + name, returns the record
+        with the restored paths or None on a miss"""
+        record = self.get(key)
+        if record is None:
+            return None
+        for name, path in record["files"].items():
+            out_path = os.path.join(out_dir, prefix + name)
+            _copy(path, out_path)
+            record["files"][name] = out_path
+        return record
+
+
+class BaselineCache:
+    """bicubic baselines of the lr images and their metrics against the GT, which do
+    not depend on the model, so they are computed once and shared by all runs. Keyed
+    by the lr (and GT) file hash, the scale and the resize method.
+
+    Parameters
+    ----------
+    root : str, optional
+        dir of the cache, by default data/interim/baseline_cache of the project
+    """
+
+    def __init__(self, root=str(project_dir / "data" / "interim" / "baseline_cache")):
+        self.store = OutputStore(root)
+
+    def get_or_compute(self, lr_path, scale, method, out_path, compute, gt_path=None):
+        """writes the bicubic image of lr_path to out_path and returns it with its
+        metrics, from the cache or computed by compute() -> (PIL image, metrics)
+
+        Parameters
+        ----------
+        lr_path : str
+        scale : int
+        method : str
+            name of the resize in compute, e.g. pil or cv2, as they differ slightly
+        out_path : str
+            png path of the bicubic image
+        compute : function
+            called on a miss, returns (PIL image, json serialisable metrics or None)
+        gt_path : str, optional
+            GT image the metrics are computed against, by default None
+        """
+        key = OutputStore.key(
+            kind="bicubic",
+            lr=file_hash(lr_path),
+            gt=file_hash(gt_path) if gt_path else None,
+            scale=scale,
+            method=method,
+        )
+        record = self.store.get(key)
+        if record is not None:
+            _copy(record["files"]["bicubic_hr.png"], out_path)
+            return Image.open(out_path), record["metrics"]
+        bicubic_hr, metrics = compute()
+        bicubic_hr.save(out_path)
+        self.store.put(key, {"bicubic_hr.png": out_path}, metrics)
+        return bicubic_hr, metrics
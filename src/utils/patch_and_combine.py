@@ -1,5 +1,5 @@
 # reference: https://github.com/Mr-TalhaIlyas/EMPatches/blob/8970e749fb2226b3c18ab057886ea142c95d635c/
-from .scripts.empatches_0 import EMPatches
+from .scripts.empatches_0 import EMPatches, PatchMerger, linear_window
 import os
 import sys
 
@@ -7,19 +7,17 @@ import sys
 # sys.path.insert(0, os.path.abspath('..'))
 # print(sys.path)
 
-import cv2
 from PIL import Image
 import numpy as np
-import matplotlib.pyplot as plt
 
-from src.visualization.plot_utils import (
-    plot_image_grid,
-    inference_plot_and_save,
-    compare_images,
-)
+# cv2 and the plotting utils are imported by the test functions using them, so the
+# tiling functions used for inference only need numpy and PIL
 
 
 def patch_combine_test():
+    import cv2
+    from src.visualization.plot_utils import compare_images
+
     img = cv2.imread("src/utils/butterfly.png")
     img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
@@ -49,6 +47,8 @@ def split_lr_merge_hr(lr_img, patch_size, scale=2):
     scale : int, optional
         _description_, by default 2
     """
+    import cv2
+    from src.visualization.plot_utils import compare_images
 
     if not isinstance(lr_img, np.ndarray):
         lr_img = np.array(lr_img)
@@ -73,7 +73,7 @@ def split_lr_merge_hr(lr_img, patch_size, scale=2):
 
     # now get the indices for merging scaled patches
     # _, hr_indices = emp.extract_patches(bicubic_hr, patchsize=patch_size*scale, overlap=0.2)
-    hr_indices = [tuple(x * 2 for x in i) for i in lr_indices]
+    hr_indices = [tuple(x * scale for x in i) for i in lr_indices]
 
     hr_merged_img = emp.merge_patches(hr_patches, hr_indices)
     hr_merged_img = hr_merged_img.astype(np.uint8)
@@ -85,14 +85,20 @@ def split_lr_merge_hr(lr_img, patch_size, scale=2):
     compare_images(bicubic_hr, hr_merged_img)
 
 
-def creates_lr_patches_hr_merge_indices(lr_img, patch_size, scale=2):
+def creates_lr_patches_hr_merge_indices(
+    lr_img, patch_size, scale=2, as_array=False, overlap=0.2
+):
     """keep the patch-size as large as possible for which SR method fits in GPU memory to keep the error due to patch-wise SR
 
     Parameters
     ----------
     lr_img : lr img
     scale : int, optional
-        _description_, by default 2
+        upscale factor of the SR model, the lr indices are multiplied by it, by default 2
+    as_array : bool, optional
+        return the lr patches as np arrays instead of PIL images, by default False
+    overlap : float, optional
+        overlap between the patches, by default 0.2
     """
 
     if not isinstance(lr_img, np.ndarray):
@@ -100,25 +106,73 @@ def creates_lr_patches_hr_merge_indices(lr_img, patch_size, scale=2):
 
     emp = EMPatches()
     lr_patches, lr_indices = emp.extract_patches(
-        lr_img, patchsize=patch_size, overlap=0.2
+        lr_img, patchsize=patch_size, overlap=overlap
     )
 
-    lr_patches = [Image.fromarray(patch, mode="RGB") for patch in lr_patches]
+    if not as_array:
+        lr_patches = [Image.fromarray(patch, mode="RGB") for patch in lr_patches]
     # now get the indices for merging scaled patches
     # _, hr_indices = emp.extract_patches(bicubic_hr, patchsize=patch_size*scale, overlap=0.2)
-    hr_indices = [tuple(x * 2 for x in i) for i in lr_indices]
+    # lr patches start and end on integer pixels, including the ones shifted to
+    # end at the image border, so the hr patches tile the hr image exactly
+    hr_indices = [tuple(x * scale for x in i) for i in lr_indices]
 
     return lr_patches, hr_indices
 
 
-def merge_hr_patches(hr_patches, hr_indices):
-    for i, patch in enumerate(hr_patches):
-        if not isinstance(patch, np.ndarray):
-            hr_patches[i] = np.array(patch)
+def lr_patch_views_hr_indices(lr, patch_size, scale=2, overlap=0.2):
+    """zero-copy alternative to creates_lr_patches_hr_merge_indices. The lr patches
+    are a strided view of lr and batches are gathered from it by their offsets, so
+    no array or PIL image is created per patch.
+
+    Parameters
+    ----------
+    lr : np.ndarray
+        (H, W, C) lr image, e.g. a np.memmap
+    patch_size : int
+    scale : int, optional
+        upscale factor of the SR model, by default 2
+    overlap : float, optional
+        overlap between the patches, by default 0.2
+
+    Returns
+    -------
+    (windows, lr offsets, hr indices). windows[oy, ox] with a batch of offsets
+    gives the (N, C, h, w) lr patches, hr indices is an (N, 4) int array of
+    (yStart, yEnd, xStart, xEnd) in the hr image, as creates_lr_patches_hr_merge_indices
+    """
     emp = EMPatches()
-    hr_merged_img = emp.merge_patches(hr_patches, hr_indices)
-    hr_merged_img = hr_merged_img.astype(np.uint8)
-    hr_merged_img = Image.fromarray(hr_merged_img, mode="RGB")
+    windows, offsets, (h, w) = emp.extract_patch_views(
+        lr, patchsize=patch_size, overlap=overlap
+    )
+    oy, ox = offsets[:, 0], offsets[:, 1]
+    hr_indices = np.stack([oy, oy + h, ox, ox + w], axis=1) * scale
+    return windows, offsets, hr_indices
+
+
+def merge_hr_patches(hr_patches, hr_indices, out=None, mode="overwrite", window=None):
+    """merges the sr patches in place into a uint8 hr image
+
+    Parameters
+    ----------
+    hr_patches : list of PIL images or np arrays, or one (N, H, W, C) uint8 np array or torch tensor
+    hr_indices : hr indices from creates_lr_patches_hr_merge_indices
+    out : np.ndarray, optional
+        preallocated (H, W, 3) uint8 buffer to merge into, by default allocated here
+    mode : str, optional
+        PatchMerger mode for the overlaps, by default "overwrite". blend weights the
+        patches with window and fades the overlaps from one patch into the next
+    window : function, optional
+        1D window of the blend mode, by default linear_window
+    """
+    if isinstance(hr_patches, list):
+        hr_patches = [np.asarray(patch) for patch in hr_patches]
+    if out is None:
+        hr_h, hr_w = np.asarray(hr_indices).max(0)[[1, 3]]
+        out = np.zeros((hr_h, hr_w, 3), dtype=np.uint8)
+    merger = PatchMerger(out=out, mode=mode, window=window or linear_window)
+    merger.add(hr_patches, hr_indices)
+    hr_merged_img = Image.fromarray(merger.result(), mode="RGB")
     return hr_merged_img
 
 
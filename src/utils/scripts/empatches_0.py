@@ -245,6 +245,54 @@ class EMPatches(object):
         return data_patches, indices
 
 
+    def extract_patch_views(self, data, patchsize, overlap=None, stride=None):
+        '''
+        Same windows as 'extract_patches' for images, but as one zero-copy strided view of data
+        instead of a list of patches, so batches can be gathered straight from data (e.g. a np.memmap)
+        without a python object per patch.
+
+        Parameters
+        ----------
+        data : image of shape [H, W] or [H, W, C].
+        patchsize, overlap, stride : as in 'extract_patches'.
+
+        Returns
+        -------
+        windows : read-only view of shape [H-h+1, W-w+1, (C,) h, w]; windows[y, x] is the patch at offset (y, x).
+        offsets : (N, 2) int array of the (yOffset, xOffset) of the patches, in the order of 'extract_patches'.
+                  A batch is gathered with windows[offsets[i:j, 0], offsets[i:j, 1]].
+        windowsize : (h, w) of the patches, the indices of a patch are
+                     (yOffset, yOffset+h, xOffset, xOffset+w).
+        '''
+        height, width = data.shape[:2]
+        windowSizeY = min(patchsize, height)
+        windowSizeX = min(patchsize, width)
+
+        if stride is not None:
+            stepSizeY = stepSizeX = stride
+        elif overlap is not None:
+            stepSizeY = windowSizeY - int(math.floor(windowSizeY * overlap))
+            stepSizeX = windowSizeX - int(math.floor(windowSizeX * overlap))
+        else:
+            stepSizeY = stepSizeX = 1
+
+        def window_offsets(length, windowSize, stepSize):
+            last = length - windowSize
+            offsets = list(range(0, last+1, stepSize))
+            # one additional window to get 100% coverage
+            if len(offsets) == 0 or offsets[-1] != last:
+                offsets.append(last)
+            return offsets
+
+        yOffsets = window_offsets(height, windowSizeY, stepSizeY)
+        xOffsets = window_offsets(width, windowSizeX, stepSizeX)
+        # x outer and y inner loop as in 'extract_patches'
+        xGrid, yGrid = np.meshgrid(xOffsets, yOffsets, indexing='ij')
+        offsets = np.stack([yGrid.ravel(), xGrid.ravel()], axis=1)
+
+        windows = np.lib.stride_tricks.sliding_window_view(data, (windowSizeY, windowSizeX), axis=(0, 1))
+        return windows, offsets, (windowSizeY, windowSizeX)
+
     def merge_patches(self, data_patches, indices, mode='overwrite'):
         '''
         Parameters
@@ -261,120 +309,133 @@ class EMPatches(object):
         -------
         Stitched image.
         '''
-        modes = ["overwrite", "max", "min", "avg"]
-        if mode not in modes:
-            raise ValueError(f"mode has to be either one of {modes}, but got {mode}")
-
         dims = len(indices[-1])
-        
-        if dims==2:
-            orig_h = indices[-1][1]
-        elif dims==4:
-            orig_h = indices[-1][1]
-            orig_w = indices[-1][3]
-        elif dims==6:
-            orig_h = indices[-1][1]
-            orig_w = indices[-1][3]
-            orig_d = indices[-1][5]
-        
-        ### There is scope here for rgb/hyperspectral volume (i.e. 4D -> 3 spatial and 1 spectral dimensions, simplest case is only 3 channles for the spectral dimension)
-        rgb = True
-        if len(data_patches[0].shape) == 2:
-            rgb = False
-        
-        if mode == 'min':
-            if dims == 2:
-                empty_data = np.zeros((orig_h)).astype(np.float32) + np.inf # using float here is better
-                
-            elif dims==4:
-                if rgb:
-                    empty_data = np.zeros((orig_h, orig_w, data_patches[0].shape[-1])).astype(np.float32) + np.inf # using float here is better
-                else:
-                    empty_data = np.zeros((orig_h, orig_w)).astype(np.float32) + np.inf # using float here is better
+        # spatial size from the patch ends, channels from the patches
+        shape = tuple(int(x) for x in np.asarray(indices).max(0)[1::2]) + tuple(np.shape(data_patches[0])[dims // 2:])
 
-            elif dims==6:
-                empty_data = np.zeros((orig_h, orig_w, orig_d)).astype(np.float32) + np.inf # using float here is better
-                
-        else:
-            if dims == 2:
-                empty_data = np.zeros((orig_h)).astype(np.float32) # using float here is better
-                
-            elif dims==4:
-                if rgb:
-                    empty_data = np.zeros((orig_h, orig_w, data_patches[0].shape[-1])).astype(np.float32) # using float here is better
-                else:
-                    empty_data = np.zeros((orig_h, orig_w)).astype(np.float32) # using float here is better
+        merger = PatchMerger(shape=shape, dtype=np.float32, mode=mode) # using float here is better
+        merger.add(data_patches, indices)
+        return merger.result()
 
-            elif dims==6:
-                empty_data = np.zeros((orig_h, orig_w, orig_d)).astype(np.float32) # using float here is better
 
-        for i, indice in enumerate(indices):
+def linear_window(size):
+    '''
+    Triangular (linear ramp) window, highest in the centre of the patch and lowest at its borders.
+    '''
+    ramp = np.arange(1, size + 1, dtype=np.float32)
+    return np.minimum(ramp, ramp[::-1])
 
-            if mode == 'overwrite':
 
-                if dims == 2:
-                    empty_data[indice[0]:indice[1]] = data_patches[i]
+class PatchMerger(object):
+    def __init__(self, out=None, shape=None, dtype=np.float32, mode='overwrite', window=linear_window):
+        '''
+        Streaming merge of patches into one output buffer. Patches are accumulated in place,
+        so patches can be added batch by batch. For 'overwrite', 'max' and 'min' the only
+        full size array is the output. 'avg' and 'blend' also keep a float32 HxW weight map,
+        and for an integer output a float32 accumulator of the output shape: for a HxWx3
+        uint8 output that is 16 bytes per pixel next to the 3 of the output, i.e. about
+        5.3 times the output size (e.g. 6.4 GB next to 1.2 GB for 20000x20000 rgb).
 
-                elif dims == 4:
-                    if rgb:
-                        empty_data[indice[0]:indice[1], indice[2]:indice[3], :] = data_patches[i]
-                    else:
-                        empty_data[indice[0]:indice[1], indice[2]:indice[3]] = data_patches[i]
-                        
-                elif dims==6:
-                        empty_data[indice[0]:indice[1], indice[2]:indice[3], indice[4]:indice[5]] = data_patches[i]
-                        
-                        
-            elif mode == 'max':
+        Parameters
+        ----------
+        out (Optional): preallocated output buffer, e.g. a HxWxC uint8 canvas or np.memmap.
+        shape (Optional): shape of the output buffer to allocate when out is None.
+        dtype (Optional): dtype of the output buffer to allocate when out is None.
+        mode : how to deal with overlapping patches, same as in 'merge_patches';
+                avg -> patches are summed with a per-pixel weight map and divided once in 'result'.
+                blend -> as avg, but every patch pixel is weighted by window, so the overlaps fade
+                         from one patch into the next instead of showing seams.
+        window (Optional): function(size) -> 1D weights for 'blend', the 2D weights of a patch are
+                the outer product of the windows of its height and width. By default linear_window,
+                e.g. smooth_tiled_predictions._spline_window for the squared spline.
+        '''
+        modes = ["overwrite", "max", "min", "avg", "blend"]
+        if mode not in modes:
+            raise ValueError(f"mode has to be either one of {modes}, but got {mode}")
+        if out is None:
+            out = np.zeros(shape, dtype=dtype)
 
-                if dims == 2:
-                    empty_data[indice[0]:indice[1]] = np.maximum(data_patches[i], empty_data[indice[0]:indice[1]])
-                elif dims == 4:
-                    if rgb:
-                        empty_data[indice[0]:indice[1], indice[2]:indice[3], :] = np.maximum(data_patches[i], empty_data[indice[0]:indice[1], indice[2]:indice[3], :])
-                    else:
-                        empty_data[indice[0]:indice[1], indice[2]:indice[3]] = np.maximum(data_patches[i], empty_data[indice[0]:indice[1], indice[2]:indice[3]])
-                elif dims==6:
-                        empty_data[indice[0]:indice[1], indice[2]:indice[3], indice[4]:indice[5]] = np.maximum(data_patches[i], empty_data[indice[0]:indice[1], indice[2]:indice[3], indice[4]:indice[5]])
+        self.out = out
+        self.mode = mode
+        self.acc = out
+        self.weights = None
+        self.window = window
+        # 2D windows by patch shape
+        self._windows = {}
+
+        if mode == 'min':
+            if np.issubdtype(out.dtype, np.floating):
+                out.fill(np.inf)
+            else:
+                out.fill(np.iinfo(out.dtype).max)
+        elif mode in ('avg', 'blend'):
+            if not np.issubdtype(out.dtype, np.floating):
+                self.acc = np.zeros(out.shape, dtype=np.float32)
+            else:
+                out.fill(0)
 
+    def add(self, data_patches, indices):
+        '''
+        Parameters
+        ----------
+        data_patches : patches as one (N, H, W, C) / (N, H, W) np array or torch tensor,
+                       or a list of np arrays.
+        indices : list of indices of the patches as generated by 'extract_patches', i.e.
+                  (yStart, yEnd, xStart, xEnd) for images.
+        '''
+        if hasattr(data_patches, 'detach'): # torch tensor
+            data_patches = data_patches.detach().cpu().numpy()
+
+        for patch, indice in zip(data_patches, indices):
+            sl = tuple(slice(indice[k], indice[k + 1]) for k in range(0, len(indice), 2))
+
+            if self.mode == 'overwrite':
+                self.acc[sl] = patch
+            elif self.mode == 'max':
+                np.maximum(self.acc[sl], patch, out=self.acc[sl], casting='unsafe')
+            elif self.mode == 'min':
+                np.minimum(self.acc[sl], patch, out=self.acc[sl], casting='unsafe')
+            elif self.mode == 'avg':
+                if self.weights is None:
+                    self.weights = np.zeros(self.acc.shape[:len(sl)], dtype=np.float32)
+                self.acc[sl] += patch
+                self.weights[sl] += 1
+            elif self.mode == 'blend':
+                if self.weights is None:
+                    self.weights = np.zeros(self.acc.shape[:len(sl)], dtype=np.float32)
+                w = self._window_2d(patch.shape[:len(sl)])
+                self.acc[sl] += patch * w.reshape(w.shape + (1,) * (patch.ndim - w.ndim))
+                self.weights[sl] += w
+
+    def _window_2d(self, shape):
+        if shape not in self._windows:
+            w = np.ones((), dtype=np.float32)
+            for size in shape:
+                # windows of a few pixels would be zero everywhere
+                w1d = self.window(size) if size >= 4 else np.ones(size)
+                w = np.multiply.outer(w, np.asarray(w1d, dtype=np.float32))
+            self._windows[shape] = w
+        return self._windows[shape]
+
+    def result(self):
+        '''
+        Returns
+        -------
+        The output buffer with the stitched data.
+        '''
+        if self.mode in ('avg', 'blend') and self.weights is not None:
+            # pixels not covered by any patch stay zero
+            weights = self.weights
+            weights[weights == 0] = 1
+            weights = weights.reshape(weights.shape + (1,) * (self.acc.ndim - weights.ndim))
+            self.acc /= weights
+            if self.acc is not self.out:
+                np.rint(self.acc, out=self.acc)
+                self.out[...] = self.acc
+                self.acc = self.out
+            self.weights = None
+        return self.out
 
-            elif mode == 'min':
-                if dims == 2:
-                    empty_data[indice[0]:indice[1]] = np.minimum(data_patches[i], empty_data[indice[0]:indice[1]])
-                elif dims == 4:
-                    if rgb:
-                        empty_data[indice[0]:indice[1], indice[2]:indice[3], :] = np.minimum(data_patches[i], empty_data[indice[0]:indice[1], indice[2]:indice[3], :])
-                    else:
-                        empty_data[indice[0]:indice[1], indice[2]:indice[3]] = np.minimum(data_patches[i], empty_data[indice[0]:indice[1], indice[2]:indice[3]])
-                elif dims==6:
-                        empty_data[indice[0]:indice[1], indice[2]:indice[3], indice[4]:indice[5]] = np.minimum(data_patches[i], empty_data[indice[0]:indice[1], indice[2]:indice[3], indice[4]:indice[5]])
-                    
-            elif mode == 'avg':
-
-                if dims == 2:
-                    empty_data[indice[0]:indice[1]] = np.where(empty_data[indice[0]:indice[1]] == 0,
-                                                                                    data_patches[i], 
-                                                                                    np.add(data_patches[i],empty_data[indice[0]:indice[1]])/2)
-                elif dims == 4:
-                    if rgb:
-                        empty_data[indice[0]:indice[1], indice[2]:indice[3], :] = np.where(empty_data[indice[0]:indice[1], indice[2]:indice[3], :] == 0,
-                                                                                            data_patches[i], 
-                                                                                            np.add(data_patches[i],empty_data[indice[0]:indice[1], indice[2]:indice[3], :])/2)
-                        # Below line should work with np.ones mask but giving Weights sum to zero error and is approx. 10 times slower then np.where
-                        # empty_data[indice[0]:indice[1], indice[2]:indice[3], :] = np.average(([empty_data[indice[0]:indice[1], indice[2]:indice[3], :],
-                        #                                                                         data_patches[i]]), axis=0,
-                        #                                                                         weights=(np.asarray([empty_data[indice[0]:indice[1], indice[2]:indice[3], :],
-                        #                                                                                               data_patches[i]])>0))
-                    else:
-                        empty_data[indice[0]:indice[1], indice[2]:indice[3]] = np.where(empty_data[indice[0]:indice[1], indice[2]:indice[3]] == 0,
-                                                                                        data_patches[i], 
-                                                                                        np.add(data_patches[i],empty_data[indice[0]:indice[1], indice[2]:indice[3]])/2)
-                elif dims==6:
-                        empty_data[indice[0]:indice[1], indice[2]:indice[3], indice[4]:indice[5]] = np.where(empty_data[indice[0]:indice[1], indice[2]:indice[3], indice[4]:indice[5]] == 0,
-                                                                                        data_patches[i], 
-                                                                                        np.add(data_patches[i],empty_data[indice[0]:indice[1], indice[2]:indice[3], indice[4]:indice[5]])/2)
-
-        return empty_data
 
 class BatchPatching(EMPatches):
     def __init__(self, patchsize, overlap=None, stride=None, typ='tf', vox=False):
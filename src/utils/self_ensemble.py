@@ -0,0 +1,71 @@
+import numpy as np
+
+
+# geometric self-ensemble over the D4 dihedral group (4 rotations x mirror flip),
+# https://en.wikipedia.org/wiki/Dihedral_group
+D4_KS = tuple(range(8))
+
+
+def d4_transform(batch, k):
+    """k-th D4 transform of a (N, H, W, C) batch, rotation by 90*k degrees and mirror flip for k >= 4"""
+    if k >= 4:
+        batch = batch[:, :, ::-1]
+    return np.rot90(batch, k % 4, axes=(1, 2))
+
+
+def d4_inverse(batch, k):
+    """undoes `d4_transform` with the same k (mind the opposite order of flip and rotation)"""
+    batch = np.rot90(batch, -(k % 4), axes=(1, 2))
+    if k >= 4:
+        batch = batch[:, :, ::-1]
+    return batch
+
+
+def d4_forward(pred_func, batch, ks=D4_KS):
+    """runs pred_func on the D4 transforms of a batch and undoes the transforms on the outputs.
+    Transforms giving the same shape (all of them for square patches) are stacked and
+    go through pred_func as one batch.
+
+    Parameters
+    ----------
+    pred_func : function mapping a (M, H, W, C) np array to a (M, H', W', C') np array
+    batch : np.ndarray
+        (N, H, W, C) batch of patches or images
+    ks : iterable of int, optional
+        which of the 8 transforms to run, by default all
+
+    Returns
+    -------
+    list with one (N, H', W', C') output per k, in the order of ks
+    """
+    ks = list(ks)
+    n = batch.shape[0]
+
+    # grouping transforms by shape, (H, W) for even k and (W, H) for odd k
+    groups = {}
+    for k in ks:
+        groups.setdefault(k % 2, []).append(k)
+
+    outputs = {}
+    for group in groups.values():
+        stacked = np.concatenate([d4_transform(batch, k) for k in group])
+        preds = pred_func(np.ascontiguousarray(stacked))
+        for i, k in enumerate(group):
+            outputs[k] = d4_inverse(preds[i * n : (i + 1) * n], k)
+    return [outputs[k] for k in ks]
+
+
+def d4_self_ensemble(pred_func, batch, reduce="mean", ks=D4_KS):
+    """D4 self-ensemble of pred_func on a batch, see `d4_forward`
+
+    Parameters
+    ----------
+    reduce : str, optional
+        mean or median over the transforms, by default "mean"
+    """
+    outputs = d4_forward(pred_func, batch, ks)
+    if reduce == "mean":
+        return np.mean(outputs, axis=0)
+    if reduce == "median":
+        return np.median(outputs, axis=0)
+    raise ValueError(f"reduce has to be either mean or median, but got {reduce}")
@@ -0,0 +1,56 @@
+import os
+
+from src.utils.output_store import OutputStore, file_hash
+
+metrics = {"psnr": 31.5}
+
+
+def write(path, data):
+    with open(path, mode="wb") as f:
+        f.write(data)
+    return str(path)
+
+
+def test_put_get_restore_round_trip(tmp_path):
+    store = OutputStore(str(tmp_path / "store"))
+    key = OutputStore.key(checkpoint="a", input="b", config={"ps": 256})
+    assert store.get(key) is None
+
+    src = write(tmp_path / "img_sr_hr.png", b"sr output")
+    store.put(key, {"sr_hr.png": src}, metrics)
+    # stored copies, not links, so writing the output again keeps the entry
+    write(src, b"changed")
+    record = store.get(key)
+    assert record["metrics"] == metrics
+    with open(record["files"]["sr_hr.png"], mode="rb") as f:
+        assert f.read() == b"sr output"
+
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    record = store.restore(key, str(out_dir), prefix="img_")
+    assert record["files"]["sr_hr.png"] == os.path.join(str(out_dir), "img_sr_hr.png")
+    with open(record["files"]["sr_hr.png"], mode="rb") as f:
+        assert f.read() == b"sr output"
+
+
+def test_missing_file_is_a_miss(tmp_path):
+    store = OutputStore(str(tmp_path / "store"))
+    key = OutputStore.key(input="b")
+    store.put(key, {"sr_hr.png": write(tmp_path / "sr.png", b"sr")}, metrics)
+    os.remove(store.get(key)["files"]["sr_hr.png"])
+    assert store.get(key) is None
+    assert store.restore(key, str(tmp_path)) is None
+
+
+def test_key_is_independent_of_part_order():
+    assert OutputStore.key(a=1, b={"x": 1, "y": 2}) == OutputStore.key(
+        b={"y": 2, "x": 1}, a=1
+    )
+
+
+def test_file_hash_follows_changes(tmp_path):
+    path = write(tmp_path / "a.bin", b"one")
+    first = file_hash(path)
+    assert file_hash(path) == first
+    write(path, b"two!")
+    assert file_hash(path) != first
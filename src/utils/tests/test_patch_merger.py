@@ -0,0 +1,77 @@
+import numpy as np
+
+from src.utils.scripts.empatches_0 import EMPatches, PatchMerger
+
+
+def reference_merge(data_patches, indices, mode):
+    # the loop of merge_patches before PatchMerger, 2D indices only
+    h = indices[-1][1]
+    w = indices[-1][3]
+    empty_data = np.zeros((h, w, data_patches[0].shape[-1])).astype(np.float32)
+    for patch, (y0, y1, x0, x1) in zip(data_patches, indices):
+        if mode == "overwrite":
+            empty_data[y0:y1, x0:x1, :] = patch
+        elif mode == "avg":
+            # pairwise running average
+            empty_data[y0:y1, x0:x1, :] = np.where(
+                empty_data[y0:y1, x0:x1, :] == 0,
+                patch,
+                np.add(patch, empty_data[y0:y1, x0:x1, :]) / 2,
+            )
+    return empty_data
+
+
+def test_overwrite_matches_reference():
+    img = np.random.rand(37, 53, 3).astype(np.float32)
+    patches, indices = EMPatches().extract_patches(img, patchsize=16, overlap=0.2)
+    patches = [p * (i + 1) for i, p in enumerate(patches)]
+
+    merged = EMPatches().merge_patches(patches, indices, mode="overwrite")
+    np.testing.assert_array_equal(merged, reference_merge(patches, indices, "overwrite"))
+
+
+def test_overwrite_batched_into_uint8_canvas():
+    img = np.random.randint(0, 256, (37, 53, 3), dtype=np.uint8)
+    patches, indices = EMPatches().extract_patches(img, patchsize=16, overlap=0.2)
+
+    merger = PatchMerger(out=np.zeros_like(img), mode="overwrite")
+    for k in range(0, len(patches), 4):
+        merger.add(np.stack(patches[k : k + 4]), indices[k : k + 4])
+    np.testing.assert_array_equal(merger.result(), img)
+
+
+def test_avg_matches_reference_for_two_overlaps():
+    # patches along the width only, so no pixel is covered by more than two patches
+    # and the pairwise average of the old merge is the mean
+    img = np.random.rand(16, 61, 1).astype(np.float32) + 0.5
+    patches, indices = EMPatches().extract_patches(img, patchsize=16, overlap=0.25)
+    patches = [p * (i + 1) for i, p in enumerate(patches)]
+
+    merged = EMPatches().merge_patches(patches, indices, mode="avg")
+    np.testing.assert_allclose(
+        merged, reference_merge(patches, indices, "avg"), rtol=1e-6
+    )
+
+
+def test_avg_is_mean_of_covering_patches():
+    img = np.random.rand(37, 53, 3).astype(np.float32)
+    patches, indices = EMPatches().extract_patches(img, patchsize=16, overlap=0.4)
+    patches = [p * (i + 1) for i, p in enumerate(patches)]
+
+    total = np.zeros(img.shape, dtype=np.float64)
+    count = np.zeros(img.shape[:2] + (1,))
+    for patch, (y0, y1, x0, x1) in zip(patches, indices):
+        total[y0:y1, x0:x1] += patch
+        count[y0:y1, x0:x1] += 1
+
+    merged = EMPatches().merge_patches(patches, indices, mode="avg")
+    np.testing.assert_allclose(merged, total / count, rtol=1e-5)
+
+
+def test_avg_of_identical_patches_is_exact_in_uint8():
+    img = np.random.randint(0, 256, (37, 53, 3), dtype=np.uint8)
+    patches, indices = EMPatches().extract_patches(img, patchsize=16, overlap=0.4)
+
+    merger = PatchMerger(out=np.zeros_like(img), mode="avg")
+    merger.add(patches, indices)
+    np.testing.assert_array_equal(merger.result(), img)
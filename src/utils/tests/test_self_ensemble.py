@@ -0,0 +1,42 @@
+import numpy as np
+
+from src.utils.self_ensemble import (
+    D4_KS,
+    d4_forward,
+    d4_inverse,
+    d4_self_ensemble,
+    d4_transform,
+)
+
+# not square, so rotations by 90 degrees change the shape
+test_shape = [2, 5, 7, 3]
+
+
+def test_inverse_undoes_transform():
+    batch = np.random.rand(*test_shape)
+    for k in D4_KS:
+        np.testing.assert_array_equal(d4_inverse(d4_transform(batch, k), k), batch)
+
+
+def test_transforms_are_distinct():
+    batch = np.random.rand(1, 4, 4, 1)
+    transformed = [d4_transform(batch, k).tobytes() for k in D4_KS]
+    assert len(set(transformed)) == len(D4_KS)
+
+
+def test_forward_of_pointwise_func_is_identity():
+    batch = np.random.rand(*test_shape)
+    for output in d4_forward(lambda x: x * 2, batch):
+        np.testing.assert_array_equal(output, batch * 2)
+
+
+def test_self_ensemble_of_upscaling():
+    batch = np.random.rand(*test_shape)
+
+    def upscale(x):
+        return x.repeat(2, axis=1).repeat(2, axis=2)
+
+    for reduce in ("mean", "median"):
+        np.testing.assert_allclose(
+            d4_self_ensemble(upscale, batch, reduce=reduce), upscale(batch)
+        )
@@ -1,4 +1,3 @@
-import cv2
 from PIL import Image
 import numpy as np
 
@@ -10,12 +9,15 @@ def is_image_file(filename):
 
 def convert_from_cv2_to_image(img: np.ndarray) -> Image:
     # return Image.fromarray(img)
+    import cv2
+
     return Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
 
 
 def convert_from_image_to_cv2(img: Image) -> np.ndarray:
     # return np.asarray(img)
-   
+    import cv2
+
     if img.mode == "YCbCr":
         img = img.convert('RGB')
     return cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
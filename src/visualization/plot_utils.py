@@ -30,16 +30,19 @@ def plot_image_grid(*images, gridshape: (int, int), save: bool = False):
     plt.show()
 
 
-def calc_metrics(img1, img2):
+def calc_metrics(img1, img2, with_lpips=True):
     """calclulates psnr and ssim and requires images to be in same colorspace
 
     Parameters
     ----------
     img1 : true image
     img2 : test image
+    with_lpips : bool, optional
+        also calculate lpips, by default True. Set False when lpips is computed
+        in a batch with lpips_metrics_batch
     Returns
     -------
-    (psnr, ssim)
+    (psnr, ssim, lpips), lpips is None when with_lpips is False
     """
 
     if not isinstance(img1, np.ndarray):
@@ -59,58 +62,145 @@ def calc_metrics(img1, img2):
         gaussian_weights=False,
         full=False,
     )
+    if not with_lpips:
+        return round(psnr, 3), round(ssim, 3), None
     lpips_distance = lpips_metrics(img1, img2)
 
     return round(psnr, 3), round(ssim, 3), round(lpips_distance, 3)
 
 
+# lpips networks are loaded once per process, keyed by (net, version, device)
+_lpips_models = {}
+
+
+def get_lpips_model(net="alex", version=0.1, device="cpu"):
+    """returns the lpips network for the net type and device, it is loaded on the
+    first call and reused afterwards
+
+    Parameters
+    ----------
+    net : str, optional
+        trunk network - alex, vgg or squeeze, by default "alex"
+    version : float, optional
+        lpips version, by default 0.1
+    device : str or torch.device, optional
+        by default "cpu"
+    """
+    key = (net, str(version), str(device))
+    if key not in _lpips_models:
+        loss_fn = lpipss.LPIPS(net=net, version=version, verbose=False)
+        _lpips_models[key] = loss_fn.to(device).eval()
+    return _lpips_models[key]
+
+
 @torch.inference_mode(mode=True)
 def lpips_metrics(img1, img2):
     # requires imgs to be in np array unit8
-    use_gpu = False
-    loss_fn = lpipss.LPIPS(net="alex", version=0.1, verbose=False)
+    return lpips_metrics_batch([(img1, img2)])[0]
 
-    if use_gpu:
-        loss_fn.cuda()
 
-    # Load images
-    img1 = lpipss.im2tensor(img1)  # RGB image from [-1,1]
-    img2 = lpipss.im2tensor(img2)
+@torch.inference_mode(mode=True)
+def lpips_metrics_batch(img_pairs, net="alex", use_gpu=False):
+    """lpips distance for several image pairs. Pairs with the same image shape are
+    stacked and go through the network in one forward pass.
 
-    if use_gpu:
-        img1 = img1.cuda()
-        img2 = img2.cuda()
+    Parameters
+    ----------
+    img_pairs : list of (img1, img2), images as uint8 np arrays or PIL images
+    net : str, optional
+        trunk network, by default "alex"
+    use_gpu : bool, optional
+        by default False
 
-    # Compute distance
-    dist01 = loss_fn.forward(img1, img2)
-    # print('Distance: %.3f'%dist01)
-    torch.cuda.empty_cache()
+    Returns
+    -------
+    list of lpips distances in the order of img_pairs
+    """
+    device = "cuda" if use_gpu else "cpu"
+    loss_fn = get_lpips_model(net=net, device=device)
+
+    # grouping pair indices by image shape
+    groups = {}
+    for i, (img1, img2) in enumerate(img_pairs):
+        img1, img2 = np.asarray(img1), np.asarray(img2)
+        groups.setdefault((img1.shape, img2.shape), []).append((i, img1, img2))
+
+    distances = [None] * len(img_pairs)
+    for group in groups.values():
+        # RGB image from [-1,1]
+        img1 = torch.cat([lpipss.im2tensor(p[1]) for p in group]).to(device)
+        img2 = torch.cat([lpipss.im2tensor(p[2]) for p in group]).to(device)
+        dist = loss_fn.forward(img1, img2).cpu().flatten()
+        for (i, _, _), d in zip(group, dist):
+            distances[i] = d.item()
+    return distances
+
+
+def bicubic_baseline(gt_img, input_lr, scale=2):
+    """bicubic upscaling of the lr image and the metrics of it and of the GT itself
+    against the GT. They do not depend on the model, see BaselineCache.
 
-    return dist01.cpu().item()
+    Returns
+    -------
+    (bicubic hr PIL image, {"bicubic": [psnr, ssim, lpips], "gt": [psnr, ssim, lpips]})
+    """
+    if not isinstance(input_lr, np.ndarray):
+        input_lr = convert_from_image_to_cv2(input_lr)
+
+    bicubic_hr = cv2.resize(
+        input_lr, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC
+    )
+    if isinstance(bicubic_hr, np.ndarray):
+        bicubic_hr = convert_from_cv2_to_image(bicubic_hr)
+
+    psnr_bicubic, ssim_bicubic, _ = calc_metrics(gt_img, bicubic_hr, with_lpips=False)
+    psnr_gt, ssim_gt, _ = calc_metrics(gt_img, gt_img, with_lpips=False)
+    # one lpips forward pass for both comparisons
+    gt_arr = np.array(gt_img)
+    lpips_distance_gt, lpips_distance_bicubic = (
+        round(d, 3)
+        for d in lpips_metrics_batch(
+            [(gt_arr, gt_arr), (gt_arr, np.array(bicubic_hr))]
+        )
+    )
+    metrics = {
+        "bicubic": [float(psnr_bicubic), float(ssim_bicubic), lpips_distance_bicubic],
+        "gt": [float(psnr_gt), float(ssim_gt), lpips_distance_gt],
+    }
+    return bicubic_hr, metrics
 
 
 def inference_plot_and_save(
-    gt_img, input_lr, output_hr, output_dir=None, output_name=None
+    gt_img,
+    input_lr,
+    output_hr,
+    output_dir=None,
+    output_name=None,
+    scale=2,
+    baseline=None,
+    figure_path=None,
 ):
-    """NEED REWRITE TO HANDLE PIL AND CV2 TYPE IMAGES, CURRENT EXPECT IMAGES TO BE PIL TYPE WHICH ARE PASSES AS IT IS TO CALC-METRICS"""
+    """NEED REWRITE TO HANDLE PIL AND CV2 TYPE IMAGES, CURRENT EXPECT IMAGES TO BE PIL TYPE WHICH ARE PASSES AS IT IS TO CALC-METRICS
+
+    baseline : (bicubic hr image, metrics) of bicubic_baseline, e.g. from a
+        BaselineCache, by default computed and saved here
+    figure_path : str, optional
+        path of the comparison figure, by default output_dir + output_name +
+        "compare_<timestamp>.png"
+    """
 
     fig, axes = plt.subplots(nrows=1, ncols=3, figsize=(30, 15))
     ax = axes.ravel()
 
-    if not isinstance(input_lr, np.ndarray):
-        input_lr = convert_from_image_to_cv2(input_lr)
-
-    bicubic_hr = cv2.resize(input_lr, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
-    if isinstance(bicubic_hr, np.ndarray):
-        bicubic_hr = convert_from_cv2_to_image(bicubic_hr)
+    if baseline is None:
+        bicubic_hr, baseline_metrics = bicubic_baseline(gt_img, input_lr, scale)
+        bicubic_hr.save(output_dir + output_name + "_bicubic_hr.png")
+    else:
+        bicubic_hr, baseline_metrics = baseline
+    psnr_bicubic, ssim_bicubic, lpips_distance_bicubic = baseline_metrics["bicubic"]
+    psnr_gt, ssim_gt, lpips_distance_gt = baseline_metrics["gt"]
 
-    bicubic_hr.save(output_dir + output_name + "_bicubic_hr.png")
-
-    psnr_bicubic, ssim_bicubic, lpips_distance_bicubic = calc_metrics(
-        gt_img, bicubic_hr
-    )
     psnr_output, ssim_output, lpips_distance_output = calc_metrics(gt_img, output_hr)
-    psnr_gt, ssim_gt, lpips_distance_gt = calc_metrics(gt_img, gt_img)
 
     ax[0].imshow(gt_img)
     ax[0].set_title("GT")
@@ -143,17 +233,16 @@ def inference_plot_and_save(
         + str(lpips_distance_output)
     )
 
-    if output_dir and output_name:
-        plt.savefig(
-            (
-                output_dir
-                + output_name
-                + "compare"
-                + datetime.now().strftime("_%b_%d_%H_%M_%S_%f")
-                + ".png"
-            ),
-            bbox_inches="tight",
+    if figure_path is None and output_dir and output_name:
+        figure_path = (
+            output_dir
+            + output_name
+            + "compare"
+            + datetime.now().strftime("_%b_%d_%H_%M_%S_%f")
+            + ".png"
         )
+    if figure_path:
+        plt.savefig(figure_path, bbox_inches="tight")
     # plt.savefig("xx.svg")
     # plt.show()
     # Closing the figure to free up memory